@@ -19,9 +19,9 @@
 VERSION = '1.0'
 
 TRNSM_VERSION_MIN = '1.90'
-TRNSM_VERSION_MAX = '2.50'
+TRNSM_VERSION_MAX = '4.00'
 RPC_VERSION_MIN = 8
-RPC_VERSION_MAX = 14
+RPC_VERSION_MAX = 17
 
 # error codes
 CONNECTION_ERROR = 1
@@ -41,13 +41,47 @@ except ImportError:
     except (ImportError,AttributeError):
         quit("Please install simplejson or Python 2.6 or higher.")
 
+# decoders for the daemon's answers, fastest first; they all parse the raw
+# UTF-8 bytes without decoding the whole answer to unicode first
+json_decoders = []
+try:
+    import ujson
+    json_decoders.append(('ujson', ujson.loads))
+except ImportError:
+    pass
+try:
+    import simplejson
+    # without its C extension, simplejson is slower than Python's own json
+    if simplejson.scanner.c_make_scanner:
+        json_decoders.append(('simplejson', simplejson.loads))
+except (ImportError, AttributeError):
+    pass
+try:
+    import json as std_json
+    json_decoders.append(('json', std_json.loads))
+except ImportError:
+    json_decoders.append(('simplejson', json.loads))
+json_decoder_name, json_decode = json_decoders[0]
+
 import time
+import random
 import re
+import operator
 import base64
+import zlib
 import httplib
-import urllib2
 import socket
-socket.setdefaulttimeout(None)
+import select
+import ssl
+import errno
+import fcntl
+import threading
+import Queue
+import bisect
+import fnmatch
+import hmac
+import BaseHTTPServer
+import SocketServer
 import ConfigParser
 from optparse import OptionParser, SUPPRESS_HELP
 import sys
@@ -107,14 +141,20 @@ config.set('Connection', 'port', '9091')
 config.set('Connection', 'host', 'localhost')
 config.set('Connection', 'path', '/transmission/rpc')
 config.set('Connection', 'ssl', 'False')
+config.set('Connection', 'timeouts', 'session-stats:10,session-get:10,torrent-get:60,default:30')  # seconds
 config.add_section('Sorting')
 config.set('Sorting', 'order', 'name')
 config.add_section('Filtering')
 config.set('Filtering', 'filter', '')
 config.set('Filtering', 'invert', 'False')
+config.add_section('Proxy')
+config.set('Proxy', 'username', '')   # clients of --proxy must authenticate if set
+config.set('Proxy', 'password', '')
+config.set('Proxy', 'whitelist', '127.0.0.1')  # addresses clients may connect from, * is a wildcard
 config.add_section('Misc')
 config.set('Misc', 'compact_list', 'False')
 config.set('Misc', 'torrentname_is_progressbar', 'True')
+config.set('Misc', 'idle_timeout', '10')  # minutes without keypresses until polling slows down
 config.add_section('Colors')
 config.set('Colors', 'title_seed',       'bg:green,fg:black')
 config.set('Colors', 'title_download',   'bg:blue,fg:black')
@@ -158,79 +198,612 @@ class ColorManager:
 
 
 
-authhandler = None
-session_id = 0
+# Response to one HTTP/1.1 request, parsed as it trickles in.  feed() it
+# whatever the socket delivered; it can be used once <complete> is set.
+class IncrementalHTTPResponse:
+    def __init__(self, consumer=None):
+        self.consumer = consumer  # gets the body of successful responses instead of self.body
+        self.status   = None
+        self.reason   = ''
+        self.headers  = dict()
+        self.body     = []
+        self.received = 0      # bytes fed so far
+        self.body_received = 0 # body bytes as transferred, i.e. possibly compressed
+        self.body_decoded  = 0 # body bytes after decompression
+        self.decompressor  = None
+        self.deflate_input = None  # compressed body kept until zlib accepts its header
+        self.complete   = False
+        self.will_close = False
+        self.state  = 'status'
+        self.length = None     # bytes left in body or chunk, None: until connection closes
+        self.buffer = ''
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self):
+        return ''.join(self.body)
+
+    def feed(self, data):
+        self.received += len(data)
+        self.buffer += data
+        while not self.complete:
+            if self.state in ('body', 'chunk'):
+                if self.length is None:
+                    self.add_body(self.buffer)
+                    self.buffer = ''
+                    return
+                data, self.buffer = self.buffer[:self.length], self.buffer[self.length:]
+                self.add_body(data)
+                self.length -= len(data)
+                if self.length:
+                    return
+                if self.state == 'chunk':
+                    self.state = 'chunk-end'
+                else:
+                    self.complete = True
+            else:
+                end = self.buffer.find('\r\n')
+                if end < 0:
+                    return
+                line, self.buffer = self.buffer[:end], self.buffer[end+2:]
+                self.parse_line(line)
+
+    def add_body(self, data):
+        self.body_received += len(data)
+        if self.deflate_input is not None:
+            self.deflate_input += data
+            try:
+                data = self.decompressor.decompress(data)
+            except zlib.error:
+                # many servers send deflate without the zlib header
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = self.decompressor.decompress(self.deflate_input)
+                self.deflate_input = None
+            if data:
+                self.deflate_input = None
+        elif self.decompressor:
+            data = self.decompressor.decompress(data)
+        self.body_decoded += len(data)
+        if self.consumer and self.status == 200:
+            self.consumer.feed(data)
+        else:
+            self.body.append(data)
+
+    def feed_eof(self):
+        if self.state == 'body' and self.length is None:
+            self.complete = True
+        elif not self.received:
+            raise httplib.BadStatusLine('')
+        else:
+            raise httplib.IncompleteRead(self.read())
+
+    def parse_line(self, line):
+        if self.state == 'status':
+            try:
+                version, status, reason = (line.split(None, 2) + [''])[:3]
+                self.status, self.reason = int(status), reason
+            except ValueError:
+                raise httplib.BadStatusLine(line)
+            self.will_close = version != 'HTTP/1.1'
+            self.state = 'header'
+
+        elif self.state == 'header' and line:
+            name, value = line.split(':', 1)
+            self.headers[name.strip().lower()] = value.strip()
+
+        elif self.state == 'header':
+            connection = self.getheader('connection', '').lower()
+            if 'close' in connection:
+                self.will_close = True
+            elif 'keep-alive' in connection:
+                self.will_close = False
+
+            encoding = self.getheader('content-encoding', '').lower()
+            if encoding in ('gzip', 'x-gzip'):
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif encoding == 'deflate':
+                self.decompressor = zlib.decompressobj()
+                self.deflate_input = ''
+            elif encoding not in ('', 'identity'):
+                raise httplib.HTTPException("Unsupported content encoding: %s" % encoding)
+
+            if 'chunked' in self.getheader('transfer-encoding', '').lower():
+                self.state = 'chunk-size'
+            elif self.headers.has_key('content-length'):
+                self.state  = 'body'
+                self.length = int(self.headers['content-length'])
+                self.complete = self.length == 0
+            else:
+                self.state = 'body'
+                self.will_close = True
+
+        elif self.state == 'chunk-size':
+            try:
+                self.length = int(line.split(';')[0], 16)
+            except ValueError:
+                raise httplib.HTTPException("Invalid chunk size: %s" % line)
+            self.state = ('trailer', 'chunk')[self.length > 0]
+
+        elif self.state == 'chunk-end':
+            self.state = 'chunk-size'
+
+        elif self.state == 'trailer' and not line:
+            self.complete = True
+
+
+# Decoder for torrent-get answers that is fed the body as it arrives.  Each
+# torrent is decoded on its own and passed through <handle> right away, so
+# neither the whole body nor a tree of all torrents has to be kept around.
+class TorrentListDecoder:
+    TOKEN = re.compile(r'\s*(?:("(?:[^"\\]|\\.)*")|([{}\[\]:,])|([^\s{}\[\]:,"]+))')
+    SEPARATOR = re.compile(r'[\s,]*')
+
+    def __init__(self, handle):
+        self.handle   = handle
+        self.torrents = []      # what <handle> returned
+        self.keys     = None    # field names of table format answers
+        # torrents are decoded by json.JSONDecoder, not json_decode: only its
+        # raw_decode() tells where an object ends ('stream' in --benchmark-json)
+        self.decoder  = json.JSONDecoder()
+        self.state    = 'envelope'  # -> 'torrents' -> 'rest'
+        self.envelope = []      # answer with an empty torrent list
+        self.buffer   = ''
+        self.path     = []      # keys of the objects/arrays the envelope scan is in
+        self.key      = None
+        self.previous = None
+
+    def feed(self, data):
+        self.buffer += data
+        if self.state == 'envelope':
+            self.find_torrents()
+        if self.state == 'torrents':
+            self.decode_torrents()
+        if self.state == 'rest':
+            self.envelope.append(self.buffer)
+            self.buffer = ''
+
+    def find_torrents(self):
+        pos = 0
+        while True:
+            m = self.TOKEN.match(self.buffer, pos)
+            # scalars at the end of the buffer may be incomplete
+            if not m or (m.group(3) and m.end() == len(self.buffer)):
+                break
+            pos = m.end()
+            token = m.group(1) or m.group(2) or m.group(3)
+            if token == ':':
+                self.key = self.previous
+            elif token in '{[':
+                self.path.append(self.key)
+                self.key = None
+                if self.path == [None, '"arguments"', '"torrents"']:
+                    self.state = 'torrents'
+                    self.envelope.append(self.buffer[:pos] + ']')
+                    self.buffer = self.buffer[pos:]
+                    return
+            elif token in '}]':
+                self.path.pop()
+            self.previous = token
+        self.envelope.append(self.buffer[:pos])
+        self.buffer = self.buffer[pos:]
+
+    def decode_torrents(self):
+        pos = 0
+        while True:
+            pos = self.SEPARATOR.match(self.buffer, pos).end()
+            if pos == len(self.buffer):
+                break
+            if self.buffer[pos] == ']':
+                self.state = 'rest'
+                pos += 1
+                break
+            try:
+                torrent, pos = self.decoder.raw_decode(self.buffer, pos)
+            except ValueError:
+                break  # rest of this torrent hasn't arrived yet
+            if isinstance(torrent, list):
+                if self.keys is None:
+                    self.keys = torrent
+                    continue
+                torrent = dict(zip(self.keys, torrent))
+            self.torrents.append(self.handle(torrent))
+        self.buffer = self.buffer[pos:]
+
+    def close(self):
+        """Return the complete answer, including the handled torrents."""
+        response = json_decode(''.join(self.envelope) + self.buffer)
+        if self.state == 'torrents':
+            raise ValueError("Torrent list ends prematurely")
+        elif self.state == 'rest':
+            response['arguments']['torrents'] = self.torrents
+        return response
+
+
+# Persistent HTTP/1.1 connection to the daemon that can be handed out again
+# after its response has been read completely.  The socket is non-blocking
+# while a response is awaited, so it can be read whenever select() says so.
+class PooledConnection:
+    def __init__(self, host, port, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context  # set for https
+        self.sock = None
+        self.response = None
+        self.consumer = None
+        self.error    = None
+        self.requests   = 0   # requests sent over this connection
+        self.reconnects = 0   # times the socket had to be opened again
+        self.body_received = 0  # response bytes on the wire ...
+        self.body_decoded  = 0  # ... and after decompression
+        self.request = None
+        self.reused  = False
+        self.deadline = None  # time by which the response must be complete
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def time_left(self):
+        if self.error:
+            return 0
+        return max(0, self.deadline - time.time())
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.time_left())
+        if self.ssl_context:
+            try:
+                self.sock = self.ssl_context.wrap_socket(self.sock, server_hostname=self.host)
+            except ssl.CertificateError, msg:
+                # not a socket.error, but callers only expect those
+                self.close()
+                raise ssl.SSLError(0, str(msg))
+
+    def send(self, method, path, body, headers, consumer=None, timeout=30):
+        # remember the request so it can be replayed if the daemon closed
+        # the connection while it was sitting idle in the pool
+        headers = dict(headers, Host="%s:%s" % (self.host, self.port))
+        headers['Content-Length'] = len(body)
+        self.request = "%s %s HTTP/1.1\r\n" % (method, path) + \
+            ''.join(["%s: %s\r\n" % header for header in headers.items()]) + "\r\n" + body
+        self.consumer = consumer
+        self.deadline = time.time() + timeout
+        self.reused = self.sock is not None
+        try:
+            if not self.reused:
+                self.connect()
+            self.write()
+        except socket.error:
+            if not self.reused: raise
+            self.reconnect()
+        self.requests += 1
+
+    def write(self):
+        self.response = IncrementalHTTPResponse(self.consumer)
+        self.error    = None
+        self.sock.settimeout(self.time_left() or 0.001)
+        self.sock.sendall(self.request)
+        self.sock.setblocking(0)
+
+    def read(self):
+        """Read what has arrived without waiting; true once the response is complete or failed."""
+        if self.error:
+            return True
+        try:
+            try:
+                self.read_available()
+            except (httplib.HTTPException, socket.error):
+                # server closed a kept-alive connection without answering
+                if not self.reused or self.response.received: raise
+                self.reconnect()
+        except (httplib.HTTPException, socket.error, zlib.error), msg:
+            self.error = msg
+        if not (self.response.complete or self.error or self.time_left()):
+            self.error = socket.timeout('timed out')
+        return self.response.complete or self.error != None
+
+    def read_available(self):
+        try:
+            while not self.response.complete:
+                data = self.sock.recv(65536)
+                if not data:
+                    self.response.feed_eof()
+                    return
+                received, decoded = self.response.body_received, self.response.body_decoded
+                self.response.feed(data)
+                self.body_received += self.response.body_received - received
+                self.body_decoded  += self.response.body_decoded - decoded
+        except ssl.SSLError, msg:
+            if msg.args[0] != ssl.SSL_ERROR_WANT_READ: raise
+        except socket.error, msg:
+            if msg.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK): raise
+
+    def getresponse(self):
+        while not self.read():
+            select.select([self], [], [], self.time_left())
+        if self.error:
+            raise self.error
+        return self.response
+
+    def reconnect(self):
+        self.close()
+        self.reconnects += 1
+        self.reused = False
+        self.connect()
+        self.write()
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+class ConnectionPool:
+    MAX_IDLE = 4
+
+    def __init__(self, host, port, use_ssl=False, section='Connection'):
+        self.host = host
+        self.port = port
+        self.ssl  = use_ssl
+        self.section = section  # saves the session id
+        # verifies certificate and host name like urllib2 does
+        self.ssl_context = None
+        if use_ssl:
+            self.ssl_context = ssl.create_default_context()
+        self.auth = None
+        self.quit_on_error = True  # else requests answer 'connection lost'
+        self.session_id = load_session_id(section)
+        self.idle = []
+        self.connections = []
+
+    def set_credentials(self, username, password):
+        self.auth = 'Basic ' + base64.b64encode('%s:%s' % (username, password))
+
+    def set_session_id(self, session_id):
+        if session_id != self.session_id:
+            self.session_id = session_id
+            store_session_id(self.section, session_id)
+
+    def acquire(self):
+        if self.idle:
+            return self.idle.pop()
+        conn = PooledConnection(self.host, self.port, self.ssl_context)
+        self.connections.append(conn)
+        return conn
+
+    def release(self, conn, reusable=True):
+        if reusable and len(self.idle) < self.MAX_IDLE:
+            self.idle.append(conn)
+        else:
+            debug("closing connection after %d requests, %d reconnects, %d of %d bytes transferred\n" %
+                  (conn.requests, conn.reconnects, conn.body_received, conn.body_decoded))
+            conn.close()
+            self.connections.remove(conn)
+
+    def get_stats(self):
+        return [{'requests':c.requests, 'reconnects':c.reconnects, 'idle':c in self.idle,
+                 'received':c.body_received, 'decoded':c.body_decoded}
+                for c in self.connections]
+
+# The daemon answers 409 until a request carries its current session id.
+# Remember the last one per connection section of the config file so the
+# next start can skip that round trip.
+def session_ids_file():
+    return os.path.join(os.path.dirname(os.path.abspath(cmd_args.configfile)), 'session-ids')
+
+def read_session_ids():
+    session_ids = dict()
+    try:
+        for line in open(session_ids_file()):
+            try:
+                section, session_id = line.rstrip('\n').rsplit(' ', 1)
+                session_ids[section] = session_id
+            except ValueError:
+                pass
+    except IOError:
+        pass
+    return session_ids
+
+def load_session_id(section):
+    return read_session_ids().get(section)
+
+def store_session_id(section, session_id):
+    session_ids = read_session_ids()
+    session_ids[section] = session_id
+    try:
+        file = open(session_ids_file(), 'w')
+        # forget sections that were removed from the config file
+        for name in sorted(filter(config.has_section, session_ids.keys())):
+            file.write("%s %s\n" % (name, session_ids[name]))
+        file.close()
+    except IOError, msg:
+        debug("Cannot write %s: %s\n" % (session_ids_file(), msg))
+
+request_timeouts = dict()  # method -> seconds, see parse_timeouts()
+def parse_timeouts(value):
+    """Turn the 'timeouts' setting into a dict; raise ValueError if it's malformed."""
+    timeouts = dict()
+    for item in value.split(','):
+        try:
+            method, seconds = item.split(':')
+            timeouts[method.strip()] = float(seconds)
+        except ValueError:
+            raise ValueError("expected METHOD:SECONDS, got '%s'" % item.strip())
+        if timeouts[method.strip()] <= 0:
+            raise ValueError("timeout of %s must be positive" % method.strip())
+    return timeouts
+
+def get_request_timeout(method):
+    """Seconds to wait for the answer to <method> according to the 'timeouts' setting."""
+    return request_timeouts.get(method, request_timeouts.get('default', 30))
+
+# Daemons on the same host and port share a pool only if they also have the
+# same path and user, since the pool keeps credentials and session id.
+connection_pools = dict()
+def get_connection_pool(host, port, path, username='', password='', ssl=None, section='Connection'):
+    key = (host, port, re.sub('/+', '/', '/' + path), username)
+    if not connection_pools.has_key(key):
+        if ssl is None:
+            ssl = config.getboolean('Connection', 'ssl')
+        connection_pools[key] = ConnectionPool(host, port, ssl, section)
+        if username and password:
+            connection_pools[key].set_credentials(username, password)
+    return connection_pools[key]
+
 
 # Handle communication with Transmission server.
 class TransmissionRequest:
-    def __init__(self, host, port, path, method=None, tag=None, arguments=None):
-        self.url           = create_url(host, port, path)
+    def __init__(self, pool, path, method=None, tag=None, arguments=None):
+        self.url           = create_url(pool.host, pool.port, path)
+        self.path          = re.sub('/+', '/', '/' + path)
+        self.pool          = pool
+        self.request_data  = None
         self.open_request  = None
+        self.torrent_handler = None
+        self.decoder       = None
+        self.retried       = False
         self.last_update   = 0
+        self.sent_at       = 0
         if method and tag:
             self.set_request_data(method, tag, arguments)
 
     def set_request_data(self, method, tag, arguments=None):
+        self.tag = tag
+        self.timeout = get_request_timeout(method)
         request_data = {'method':method, 'tag':tag}
         if arguments: request_data['arguments'] = arguments
-        self.http_request = urllib2.Request(url=self.url, data=json.dumps(request_data))
+        self.request_data = json.dumps(request_data)
+
+    def stream_torrents(self, handle):
+        """Decode torrents of the answer while it arrives and replace them with handle(torrent)."""
+        self.torrent_handler = handle
 
-    def send_request(self):
+    def send_request(self, retry=False):
         """Ask for information from server OR submit command."""
 
-        global session_id
-        try:
-            if session_id:
-                self.http_request.add_header('X-Transmission-Session-Id', session_id)
-            self.open_request = urllib2.urlopen(self.http_request)
-            debug(self.http_request.get_data() + "\n\n")
-        except AttributeError:
-            # request data (http_request) isn't specified yet -- data will be available on next call
-            pass
+        if self.request_data is None:
+            # request data isn't specified yet -- data will be available on next call
+            return
 
-        # authentication
-        except urllib2.HTTPError, e:
-            try:
-                msg = html2text(str(e.read()))
-            except:
-                msg = str(e)
+        self.retried = retry
+        headers = {'Content-Type': 'application/json', 'Accept-Encoding': 'gzip, deflate'}
+        if self.pool.session_id:
+            headers['X-Transmission-Session-Id'] = self.pool.session_id
+        if self.pool.auth:
+            headers['Authorization'] = self.pool.auth
 
-            # extract session id and send request again
-            m = re.search('X-Transmission-Session-Id:\s*(\w+)', msg)
-            try:
-                session_id = m.group(1)
-                self.send_request()
-            except AttributeError:
-                quit(str(msg) + "\n", CONNECTION_ERROR)
+        if self.torrent_handler:
+            self.decoder = TorrentListDecoder(self.torrent_handler)
+        conn = self.pool.acquire()
+        try:
+            conn.send('POST', self.path, self.request_data, headers, self.decoder, self.timeout)
+            self.sent_at = time.time()
+            debug(self.request_data + "\n\n")
+        except (httplib.HTTPException, socket.error), msg:
+            conn.error = msg  # reported by get_response()
+        self.open_request = conn
+
+    def response_ready(self):
+        """Check whether get_response() would return without waiting for the daemon."""
+        if self.open_request == None:
+            return True
+        return self.open_request.read() and not self.renew_session()
 
-        except urllib2.URLError, msg:
-            try:
-                reason = msg.reason[1]
-            except IndexError:
-                reason = str(msg.reason)
-            quit("Cannot connect to %s: %s\n" % (self.http_request.host, reason), CONNECTION_ERROR)
+    def renew_session(self):
+        """Send the request once more if the daemon rejected it for an outdated session id."""
+        conn = self.open_request
+        if conn.error or conn.response.status != 409 or self.retried:
+            return False
+        session_id = conn.response.getheader('X-Transmission-Session-Id')
+        if not session_id:
+            return False
+        self.pool.release(conn, reusable=not conn.response.will_close)
+        self.pool.set_session_id(session_id)
+        self.send_request(retry=True)
+        return True
+
+    def cancel(self):
+        """Forget about previously sent request without reading the response."""
+        if self.open_request != None:
+            self.pool.release(self.open_request, reusable=False)
+            self.open_request = None
+
+    def connection_error(self, reason):
+        if self.pool.quit_on_error:
+            quit("Cannot connect to %s: %s\n" % (self.url, reason), CONNECTION_ERROR)
+        return {'result': 'connection lost', 'reason': reason, 'tag': self.tag}
 
     def get_response(self):
         """Get response to previously sent request."""
 
         if self.open_request == None:
             return {'result': 'no open request'}
-        response = self.open_request.read()
-        # work around regression in Python 2.6.5, caused by http://bugs.python.org/issue8797
-        if authhandler:
-            authhandler.retried = 0
         try:
-            data = json.loads(unicode(response))
-            debug(data)
-        except ValueError:
-            quit("Cannot parse response: %s\n" % response, JSON_ERROR)
+            while True:
+                conn = self.open_request
+                http_response = conn.getresponse()
+                if not self.renew_session():
+                    break
+            response = http_response.read()
+        except socket.timeout:
+            self.open_request = None
+            self.pool.release(conn, reusable=False)
+            return {'result': 'timed out', 'tag': self.tag}
+        except (httplib.HTTPException, socket.error), msg:
+            self.open_request = None
+            self.pool.release(conn, reusable=False)
+            try:
+                reason = msg.args[1]
+            except IndexError:
+                reason = str(msg) or msg.__class__.__name__
+            return self.connection_error(reason)
         self.open_request = None
+        self.pool.release(conn, reusable=not http_response.will_close)
+
+        # authentication
+        if http_response.status != 200:
+            msg = html2text(response) or http_response.reason
+            if self.pool.quit_on_error:
+                quit(str(msg) + "\n", CONNECTION_ERROR)
+            return {'result': 'connection lost', 'reason': str(msg).strip(), 'tag': self.tag}
+
+        try:
+            if self.decoder:
+                data = self.decoder.close()
+            else:
+                data = json_decode(response)
+            debug(data)
+        except ValueError, msg:
+            quit("Cannot parse response: %s\n" % (response or msg), JSON_ERROR)
         return data
 
 
 # End of Class TransmissionRequest
 
 
+# What the daemon reported at some point.  Published snapshots are never
+# changed, so the interface can read them while the next one is assembled.
+class Snapshot:
+    def __init__(self, version, torrents, stats, details, stale_since=None, error=None):
+        self.version  = version
+        self.torrents = torrents  # tuple
+        self.index    = dict([(t['id'], t) for t in torrents])
+        self.stats    = stats
+        self.details  = details
+        self.stale_since = stale_since  # time of the last answer before polls timed out
+        self.error = error  # why the daemon can't be reached, if it can't
+
+
+# Torrents in the order they are shown.  position() finds a torrent by its
+# id without scanning; the list must not be changed after that.
+class TorrentList(list):
+    def position(self, id):
+        """Return the index of the torrent with <id> or -1."""
+        try:
+            positions = self.positions
+        except AttributeError:
+            positions = self.positions = dict([(t['id'], i) for i, t in enumerate(self)])
+        return positions.get(id, -1)
+
+
 # Higher level of data exchange
 class Transmission:
     STATUS_STOPPED       = 0   # Torrent is stopped
@@ -245,6 +818,7 @@ class Transmission:
     TAG_TORRENT_DETAILS = 77
     TAG_SESSION_STATS   = 21
     TAG_SESSION_GET     = 22
+    TAG_COMMAND         = 100 # first tag of commands, each one gets its own
 
     LIST_FIELDS = [ 'id', 'name', 'downloadDir', 'status', 'trackerStats', 'desiredAvailable',
                     'rateDownload', 'rateUpload', 'eta', 'uploadRatio',
@@ -255,70 +829,98 @@ class Transmission:
                     'peersSendingToUs', 'peersGettingFromUs',
                     'seedRatioLimit', 'seedRatioMode' ]
 
-    DETAIL_FIELDS = [ 'files', 'priorities', 'wanted', 'peers', 'trackers',
-                      'activityDate', 'dateCreated', 'startDate', 'doneDate',
-                      'totalSize', 'leftUntilDone', 'comment', 'isPrivate',
-                      'hashString', 'pieceCount', 'pieceSize', 'pieces',
-                      'downloadedEver', 'corruptEver', 'peersFrom' ] + LIST_FIELDS
-
-    def __init__(self, host, port, path, username, password):
+    # fields needed for every row of the torrent list and the actions on it
+    LIST_FIELDS_BASE = [ 'id', 'name', 'downloadDir', 'status', 'desiredAvailable',
+                         'rateDownload', 'rateUpload', 'eta', 'uploadRatio',
+                         'sizeWhenDone', 'haveValid', 'haveUnchecked', 'recheckProgress',
+                         'uploadLimit', 'downloadLimit', 'uploadLimited', 'downloadLimited',
+                         'bandwidthPriority', 'seedRatioLimit', 'seedRatioMode' ]
+
+    # additional fields needed to draw, sort by or filter by something
+    LIST_FIELDS_FOR = { 'status_line': ['errorString', 'uploadedEver', 'peersConnected', 'trackerStats'],
+                        'seeders':     ['trackerStats'],
+                        'leechers':    ['trackerStats'],
+                        'active':      ['peersGettingFromUs', 'peersSendingToUs'] }
+
+    # seconds between complete torrent list fetches; polls in between only
+    # ask for torrents the daemon considers recently active
+    FULL_SYNC_INTERVAL = 60
+
+    # seconds between polls: (normally, at most while answers don't change)
+    POLL_INTERVALS = { 'torrent-list':    (1, 8),
+                       'session-stats':   (1, 8),
+                       'session-get':     (10, 60),
+                       'torrent-details': (1, 8) }
+    # seconds between polls while the user is away
+    IDLE_INTERVAL = 60
+    # arguments that change with every answer but aren't shown
+    UNWATCHED_ARGUMENTS = ['cumulative-stats', 'current-stats']
+
+    # order in which waiting requests get one of MAX_IN_FLIGHT connections
+    PRIORITY_COMMAND    = 0  # changes the user asked for
+    PRIORITY_VIEW       = 1  # data that is on the screen
+    PRIORITY_BACKGROUND = 2
+    MAX_IN_FLIGHT = 3
+
+    # seconds between attempts to reach a daemon that went away, doubling
+    RECONNECT_INTERVALS = (1, 60)
+
+    # details that never change, fetched once when a torrent's details are opened
+    DETAIL_FIELDS_STATIC = [ 'hashString', 'totalSize', 'pieceCount', 'pieceSize',
+                             'dateCreated', 'comment', 'isPrivate' ]
+
+    # details polled for each view in addition to LIST_FIELDS; 'files' is
+    # static as well but only fetched once per torrent, see files_cache
+    DETAIL_FIELDS_FOR = { 'overview': [ 'fileStats', 'peers', 'leftUntilDone',
+                                        'downloadedEver', 'corruptEver',
+                                        'activityDate', 'startDate', 'doneDate' ],
+                          'files':    [ 'fileStats' ],
+                          'peers':    [ 'peers', 'peersFrom' ],
+                          'trackers': [ 'trackers' ],
+                          'pieces':   [ 'pieces' ] }
+    # number of torrents whose file lists are kept in files_cache
+    FILES_CACHE_SIZE = 20
+
+    def __init__(self, host, port, path, username, password, ssl=None, published_pipe=None,
+                 section='Connection'):
         self.host = host
         self.port = port
         self.path = path
 
-        if username and password:
-            password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
-            password_mgr.add_password(None, create_url(host, port, path), username, password)
-            global authhandler
-            authhandler = urllib2.HTTPBasicAuthHandler(password_mgr)
-            opener = urllib2.build_opener(authhandler)
-            urllib2.install_opener(opener)
+        self.pool = get_connection_pool(host, port, path, username, password, ssl, section)
 
         # check rpc version
-        request = TransmissionRequest(host, port, path, 'session-get', self.TAG_SESSION_GET)
+        request = TransmissionRequest(self.pool, path, 'session-get', self.TAG_SESSION_GET)
         request.send_request()
         response = request.get_response()
+        if response['result'] != 'success':
+            quit("Cannot connect to %s: %s\n" % (request.url, response['result']), CONNECTION_ERROR)
 
-        self.rpc_version = response['arguments']['rpc-version']
-
-        # rpc version too old?
-        version_error = "Unsupported Transmission version: " + str(response['arguments']['version']) + \
-            " -- RPC protocol version: " + str(response['arguments']['rpc-version']) + "\n"
-
-        min_msg = "Please install Transmission version " + TRNSM_VERSION_MIN + " or higher.\n"
-        try:
-            if response['arguments']['rpc-version'] < RPC_VERSION_MIN:
-                quit(version_error + min_msg)
-        except KeyError:
-            quit(version_error + min_msg)
-
-        # rpc version too new?
-        if response['arguments']['rpc-version'] > RPC_VERSION_MAX:
-            quit(version_error + "Please install Transmission version " + TRNSM_VERSION_MAX + " or lower.\n")
-
-        # setup compatibility to Transmission <2.40
-        if self.rpc_version < 14:
-            Transmission.STATUS_CHECK_WAIT    = 1 << 0
-            Transmission.STATUS_CHECK         = 1 << 1
-            Transmission.STATUS_DOWNLOAD_WAIT = 1 << 2
-            Transmission.STATUS_DOWNLOAD      = 1 << 2
-            Transmission.STATUS_SEED_WAIT     = 1 << 3
-            Transmission.STATUS_SEED          = 1 << 3
-            Transmission.STATUS_STOPPED       = 1 << 4
+        self.setup_rpc_version(response['arguments'])
 
         # set up request list
         self.requests = {'torrent-list':
-                             TransmissionRequest(host, port, path, 'torrent-get', self.TAG_TORRENT_LIST, {'fields': self.LIST_FIELDS}),
+                             TransmissionRequest(self.pool, path),
                          'session-stats':
-                             TransmissionRequest(host, port, path, 'session-stats', self.TAG_SESSION_STATS, 21),
+                             TransmissionRequest(self.pool, path, 'session-stats', self.TAG_SESSION_STATS, 21),
                          'session-get':
-                             TransmissionRequest(host, port, path, 'session-get', self.TAG_SESSION_GET),
+                             TransmissionRequest(self.pool, path, 'session-get', self.TAG_SESSION_GET),
                          'torrent-details':
-                             TransmissionRequest(host, port, path)}
-
-        self.torrent_cache = []
+                             TransmissionRequest(self.pool, path)}
+
+        self.torrent_index = dict()  # id -> torrent
+        self.sorter        = TorrentSorter()  # used by the interface only
+        self.list_fields   = self.LIST_FIELDS
+        self.requests['torrent-list'].stream_torrents(self.receive_torrent)
+        self.details_id    = -1
+        self.details_view  = 'overview'
+        self.last_full_sync = 0
+        self.prepare_torrentlist_request()
         self.status_cache  = dict()
         self.torrent_details_cache = dict()
+        self.files_cache   = dict()  # hashString -> names and sizes of the torrent's files
+        self.files_cache_order = []  # hashStrings in files_cache, least recently cached first
+        self.hash_strings  = dict()  # id -> hashString of torrents whose details were seen
         self.peer_progress_cache   = dict()
         self.hosts_cache   = dict()
         self.geo_ips_cache = dict()
@@ -330,75 +932,453 @@ class Transmission:
             except AttributeError: self.geo_ip6 = None
             except GeoIP.error: self.geo_ip6 = None
 
+        self.intervals = dict([(name, self.POLL_INTERVALS[name][0]) for name in self.requests])
+        self.last_arguments = dict()  # request name -> arguments of its last answer
+        self.last_input   = time.time()
+        self.idle_timeout = config.getint('Misc', 'idle_timeout') * 60
+        self.last_answer  = time.time()
+        self.stale_since  = None
+        self.connection_lost = None  # reason while the daemon is unreachable
+        self.reconnect_interval = self.RECONNECT_INTERVALS[0]
+        self.reconnect_at = 0
+        self.handshake = TransmissionRequest(self.pool, path, 'session-get', self.TAG_SESSION_GET)
+
+        self.commands = dict()   # tag -> (request, error message) of commands in progress
+        self.queued_commands = []  # (request, error message) of commands waiting for a connection
+        self.command_errors = Queue.Queue()
+        self.next_command_tag  = self.TAG_COMMAND
+        self.last_command_done = 0
+
         # make sure there are no undefined values
-        self.wait_for_torrentlist_update()
-        self.requests['torrent-details'] = TransmissionRequest(self.host, self.port, self.path)
+        self.fetch(*self.requests.keys())
+        # losing the connection from now on isn't fatal anymore, see lose_connection()
+        self.pool.quit_on_error = False
+        # readable when a new snapshot is available; may be shared with other daemons
+        self.published_pipe = published_pipe or wakeup_pipe()
+        self.snapshot = Snapshot(0, (), dict(), dict())
+        self.publish()
+
+        # all requests are sent and parsed by the polling thread from now on;
+        # the interface hands it work through self.calls
+        self.calls = Queue.Queue()
+        self.calls_pipe = wakeup_pipe()  # readable when self.calls has work
+        self.worker_error = None
+        self.stopped = False
+        self.worker = threading.Thread(target=self.poll_forever)
+        self.worker.setDaemon(True)
+        self.worker.start()
+
+
+    def setup_rpc_version(self, arguments):
+        """Adapt to the daemon's version from a session-get answer; quit if it's unsupported."""
+        self.rpc_version = arguments['rpc-version']
 
+        # rpc version too old?
+        version_error = "Unsupported Transmission version: " + str(arguments['version']) + \
+            " -- RPC protocol version: " + str(arguments['rpc-version']) + "\n"
 
-    def update(self, delay, tag_waiting_for=0):
-        """Maintain up-to-date data."""
+        min_msg = "Please install Transmission version " + TRNSM_VERSION_MIN + " or higher.\n"
+        try:
+            if arguments['rpc-version'] < RPC_VERSION_MIN:
+                quit(version_error + min_msg)
+        except KeyError:
+            quit(version_error + min_msg)
 
-        tag_waiting_for_occurred = False
+        # rpc version too new?
+        if arguments['rpc-version'] > RPC_VERSION_MAX:
+            quit(version_error + "Please install Transmission version " + TRNSM_VERSION_MAX + " or lower.\n")
 
-        for request in self.requests.values():
-            if time.time() - request.last_update >= delay:
-                request.last_update = time.time()
-                response = request.get_response()
+        # setup compatibility to Transmission <2.40
+        if self.rpc_version < 14:
+            Transmission.STATUS_CHECK_WAIT    = 1 << 0
+            Transmission.STATUS_CHECK         = 1 << 1
+            Transmission.STATUS_DOWNLOAD_WAIT = 1 << 2
+            Transmission.STATUS_DOWNLOAD      = 1 << 2
+            Transmission.STATUS_SEED_WAIT     = 1 << 3
+            Transmission.STATUS_SEED          = 1 << 3
+            Transmission.STATUS_STOPPED       = 1 << 4
+        else:
+            Transmission.STATUS_STOPPED       = 0
+            Transmission.STATUS_CHECK_WAIT    = 1
+            Transmission.STATUS_CHECK         = 2
+            Transmission.STATUS_DOWNLOAD_WAIT = 3
+            Transmission.STATUS_DOWNLOAD      = 4
+            Transmission.STATUS_SEED_WAIT     = 5
+            Transmission.STATUS_SEED          = 6
+
+        # torrent-get can answer with one list of field names and a list of
+        # values for each torrent instead of repeating the names every time
+        self.table_format = self.rpc_version >= 16
+
+    def poll_forever(self):
+        try:
+            while not self.stopped:
+                self.run_calls()
+                timeout = self.update()
+                if self.dirty:
+                    self.publish()
+                self.wait(timeout)
+        except:
+            self.worker_error = sys.exc_info()
+            wake_up(self.published_pipe)
+
+    def wait(self, timeout):
+        """Sleep until a response arrives, the interface needs something or <timeout> is over."""
+        requests = self.requests.values() + [r for r, error_msg in self.commands.values()] + [self.handshake]
+        # requests that failed to connect are taken care of by update() right away
+        connections = [r.open_request for r in requests if r.open_request and r.open_request.sock]
+        try:
+            select.select([self.calls_pipe[0]] + connections, [], [], timeout)
+        except select.error:
+            pass  # interrupted by a signal
 
-                if response['result'] == 'no open request':
-                    request.send_request()
+    def stop(self):
+        self.stopped = True
+        wake_up(self.calls_pipe)
+        self.worker.join()
 
-                elif response['result'] == 'success':
-                    tag = self.parse_response(response)
-                    if tag == tag_waiting_for:
-                        tag_waiting_for_occurred = True
+    def run_calls(self):
+        woken_up(self.calls_pipe)
+        try:
+            while True:
+                function, args, done = self.calls.get_nowait()
+                function(*args)
+                if done:
+                    self.publish()
+                    done.set()
+        except Queue.Empty:
+            pass
 
-        if tag_waiting_for:
-            return tag_waiting_for_occurred
-        else:
-            return None
+    def call(self, function, *args):
+        """Run <function> on the polling thread."""
+        self.calls.put((function, args, None))
+        wake_up(self.calls_pipe)
+
+    def call_and_wait(self, function, *args):
+        """Run <function> on the polling thread and wait until its results are published."""
+        done = threading.Event()
+        self.calls.put((function, args, done))
+        wake_up(self.calls_pipe)
+        while not done.isSet():
+            done.wait(0.1)
+            self.check_worker()
+
+    def check_worker(self):
+        if self.worker_error:
+            exc_type, exc_value, exc_traceback = self.worker_error
+            raise exc_type, exc_value, exc_traceback
 
+    def publish(self):
+        self.snapshot = Snapshot(self.snapshot.version + 1, tuple(self.torrent_index.values()),
+                                 self.status_cache, self.torrent_details_cache, self.stale_since,
+                                 self.connection_lost)
+        self.dirty = False
+        wake_up(self.published_pipe)
+
+    def fileno(self):
+        """Readable when get_snapshot_version() may have changed."""
+        return self.published_pipe[0]
+
+    def get_snapshot_version(self):
+        woken_up(self.published_pipe)
+        self.check_worker()
+        return self.snapshot.version
+
+
+    def update(self):
+        """Maintain up-to-date data and return the seconds until the next request is due."""
+
+        self.update_commands()
+        if self.connection_lost:
+            return self.reconnect()
+
+        idle = self.idle_timeout and time.time() - self.last_input >= self.idle_timeout
+        timeout = self.IDLE_INTERVAL
+        due = []
+        for name, request in self.requests.items():
+            if request.open_request:
+                if not request.response_ready():
+                    continue
+                response = request.get_response()
+                self.notice_answer(response)
+                if self.connection_lost:
+                    return 0
+
+                # the answer may predate a command and would revert the
+                # change that was already applied to the cache
+                if request.sent_at < self.last_command_done:
+                    request.last_update = 0
+                elif response['result'] == 'success' and not (self.commands or self.queued_commands):
+                    self.adapt_interval(name, response['arguments'])
+                    self.parse_response(response)
+
+            if request.request_data is None:
+                continue
+            interval = (self.intervals[name], self.IDLE_INTERVAL)[bool(idle)]
+            wait = request.last_update + interval - time.time()
+            if wait <= 0:
+                due.append((self.get_priority(name), name))
+            else:
+                timeout = min(timeout, wait)
+
+        # polls that are due but don't get a connection are sent once a
+        # response frees one, which also ends wait()
+        self.dispatch(due)
+        for request in self.requests.values() + [r for r, error_msg in self.commands.values()]:
+            if request.open_request:
+                timeout = min(timeout, request.open_request.time_left())
+        return max(0, timeout)
+
+    def notice_answer(self, response):
+        """Keep track of whether the published data is still current."""
+        if response['result'] == 'connection lost':
+            self.lose_connection(response['reason'])
+        elif response['result'] == 'timed out':
+            if self.stale_since is None:
+                self.stale_since = self.last_answer
+                self.dirty = True
+        else:
+            self.last_answer = time.time()
+            if self.stale_since is not None:
+                self.stale_since = None
+                self.dirty = True
+
+    def lose_connection(self, reason):
+        """Stop polling and try to reach the daemon again from time to time."""
+        if self.connection_lost:
+            return
+        debug("connection lost: %s\n" % reason)
+        for request in self.requests.values():
+            request.cancel()
+        if self.stale_since is None:
+            self.stale_since = self.last_answer
+        self.connection_lost = reason
+        self.reconnect_interval = self.RECONNECT_INTERVALS[0]
+        self.reconnect_at = time.time() + self.reconnect_interval * random.uniform(0.5, 1.5)
+        self.dirty = True
+
+    def reconnect(self):
+        """Repeat the handshake with the daemon and resync once it answers; return seconds to wait."""
+        if self.handshake.open_request:
+            if not self.handshake.response_ready():
+                return self.handshake.open_request.time_left()
+            response = self.handshake.get_response()
+            if response['result'] == 'success':
+                # the daemon may have been up- or downgraded meanwhile
+                self.setup_rpc_version(response['arguments'])
+                self.parse_response(response)
+                self.connection_lost = None
+                self.stale_since = None
+                self.last_answer = time.time()
+                self.dirty = True
+                # fetch everything again, starting with a complete torrent list
+                self.last_full_sync = 0
+                self.prepare_torrentlist_request()
+                self.reset_intervals()
+                for request in self.requests.values():
+                    request.last_update = 0
+                return 0
+            self.connection_lost = response.get('reason', response['result'])
+            self.reconnect_interval = min(self.reconnect_interval * 2, self.RECONNECT_INTERVALS[1])
+            self.reconnect_at = time.time() + self.reconnect_interval * random.uniform(0.5, 1.5)
+            self.dirty = True
+
+        if time.time() < self.reconnect_at:
+            return self.reconnect_at - time.time()
+        self.handshake.send_request()
+        return 0
+
+    def get_priority(self, name):
+        if name == ('torrent-list', 'torrent-details')[self.details_id >= 0]:
+            return self.PRIORITY_VIEW
+        return self.PRIORITY_BACKGROUND
+
+    def dispatch(self, due):
+        """Send queued commands, then the (priority, name) polls in <due> while connections are free."""
+        free = self.MAX_IN_FLIGHT - len(self.commands) - \
+            len([r for r in self.requests.values() if r.open_request])
+        while self.queued_commands:
+            if free <= 0:
+                if not self.preempt_poll():
+                    break
+                free += 1
+            request, error_msg = self.queued_commands.pop(0)
+            request.send_request()
+            self.commands[request.tag] = (request, error_msg)
+            free -= 1
 
+        for priority, name in sorted(due):
+            if free <= 0:
+                break
+            self.requests[name].last_update = time.time()
+            self.requests[name].send_request()
+            free -= 1
+
+    def preempt_poll(self):
+        """Cancel a background poll to free its connection for a command."""
+        for name, request in self.requests.items():
+            if request.open_request and self.get_priority(name) == self.PRIORITY_BACKGROUND:
+                request.cancel()
+                request.last_update = 0
+                return True
+        return False
+
+    def adapt_interval(self, name, arguments):
+        """Poll less often while the answers stay the same."""
+        arguments = dict([(key, value) for key, value in arguments.items()
+                          if key not in self.UNWATCHED_ARGUMENTS])
+        normal, slowest = self.POLL_INTERVALS[name]
+        if arguments == self.last_arguments.get(name):
+            self.intervals[name] = min(self.intervals[name] * 2, slowest)
+        else:
+            self.intervals[name] = normal
+        self.last_arguments[name] = arguments
+
+    def notice_input(self):
+        """Poll at full speed again after the user pressed a key."""
+        self.last_input = time.time()
+        self.call(self.reset_intervals)
+
+    def reset_intervals(self):
+        for name in self.requests:
+            self.intervals[name] = self.POLL_INTERVALS[name][0]
+
+    def update_commands(self):
+        for request, error_msg in self.commands.values():
+            if not request.response_ready():
+                continue
+            response = request.get_response()
+            self.commands.pop(request.tag, None)
+            if response.get('tag', request.tag) != request.tag:
+                debug("answer to command %s came with tag %s\n" % (request.tag, response.get('tag')))
+            if response['result'] == 'connection lost':
+                self.lose_connection(response['reason'])
+            if response['result'] != 'success':
+                self.command_errors.put((error_msg + "\n" + response['result']).strip())
+                self.dirty = True  # wake up the interface to show it
+
+            # let the next poll correct what apply_command() guessed
+            self.refresh_after_command()
+
+    def refresh_after_command(self):
+        # answers to polls in progress are outdated now and would be ignored
+        self.last_command_done = time.time()
+        for poll in self.requests.values():
+            poll.cancel()
+            poll.last_update = 0
+
+    def fetch(self, *names):
+        """Send requests <names> and wait for their responses."""
+        if self.connection_lost:
+            return  # everything is fetched again after reconnecting
+        for name in names:
+            self.requests[name].send_request()
+        for name in names:
+            response = self.requests[name].get_response()
+            self.notice_answer(response)
+            if response['result'] == 'success':
+                self.parse_response(response)
+
+    def prepare_torrentlist_request(self):
+        self.torrentlist_is_full = time.time() - self.last_full_sync >= self.FULL_SYNC_INTERVAL
+        arguments = {'fields': self.list_fields}
+        if not self.torrentlist_is_full:
+            arguments['ids'] = 'recently-active'
+        if self.table_format:
+            arguments['format'] = 'table'
+        self.requests['torrent-list'].set_request_data('torrent-get', self.TAG_TORRENT_LIST, arguments)
 
     def parse_response(self, response):
         # response is a reply to torrent-get
-        if response['tag'] == self.TAG_TORRENT_LIST or response['tag'] == self.TAG_TORRENT_DETAILS:
-            for t in response['arguments']['torrents']:
-                t['uploadRatio'] = round(float(t['uploadRatio']), 2)
-                t['percentDone'] = percent(float(t['sizeWhenDone']),
-                                           float(t['haveValid'] + t['haveUnchecked']))
-                t['available'] = t['desiredAvailable'] + t['haveValid'] + t['haveUnchecked']
-                if t['downloadDir'][-1] != '/':
-                    t['downloadDir'] += '/'
-                try:
-                    t['seeders']  = max(map(lambda x: x['seederCount'],  t['trackerStats']))
-                    t['leechers'] = max(map(lambda x: x['leecherCount'], t['trackerStats']))
-                except ValueError:
-                    t['seeders']  = t['leechers'] = -1
-
-            if response['tag'] == self.TAG_TORRENT_LIST:
-                self.torrent_cache = response['arguments']['torrents']
-
-            elif response['tag'] == self.TAG_TORRENT_DETAILS:
-                # torrent list may be empty sometimes after deleting
-                # torrents.  no idea why and why the server sends us
-                # TAG_TORRENT_DETAILS, but just passing seems to help.(?)
-                try:
-                    torrent_details = response['arguments']['torrents'][0]
-                    torrent_details['pieces'] = base64.decodestring(torrent_details['pieces'])
-                    self.torrent_details_cache = torrent_details
-                    self.upgrade_peerlist()
-                except IndexError:
-                    pass
-
-        elif response['tag'] == self.TAG_SESSION_STATS:
-            self.status_cache.update(response['arguments'])
-
-        elif response['tag'] == self.TAG_SESSION_GET:
+        if response['tag'] == self.TAG_TORRENT_LIST:
+            # torrents already went through receive_torrent()
+            torrents = response['arguments']['torrents']
+            if self.torrentlist_is_full:
+                self.torrent_index = dict([(t['id'], t) for t in torrents])
+                self.last_full_sync = time.time()
+            else:
+                self.merge_torrentlist(torrents, response['arguments'].get('removed', []))
+                # daemon doesn't report removed torrents -- only full fetches are reliable
+                if not response['arguments'].has_key('removed'):
+                    self.last_full_sync = 0
+            self.prepare_torrentlist_request()
+
+        elif response['tag'] == self.TAG_TORRENT_DETAILS:
+            # torrent list may be empty sometimes after deleting
+            # torrents.  no idea why and why the server sends us
+            # TAG_TORRENT_DETAILS, but just passing seems to help.(?)
+            try:
+                torrent_details = response['arguments']['torrents'][0]
+            except IndexError:
+                return response['tag']
+            if torrent_details.has_key('pieces'):
+                torrent_details['pieces'] = base64.decodestring(torrent_details['pieces'])
+            if torrent_details.has_key('fileStats'):
+                torrent_details['wanted']     = [f['wanted']   for f in torrent_details['fileStats']]
+                torrent_details['priorities'] = [f['priority'] for f in torrent_details['fileStats']]
+            answer = torrent_details
+
+            # keep static fields and those of other views from earlier answers
+            if self.torrent_details_cache.get('id') == torrent_details['id']:
+                merged = dict(self.torrent_details_cache)
+                merged.update(torrent_details)
+                torrent_details = merged
+            elif not torrent_details.has_key('files'):
+                torrent_details['files'] = self.files_cache.get(torrent_details.get('hashString'), [])
+            if answer.has_key('files') and torrent_details.has_key('hashString'):
+                self.hash_strings[torrent_details['id']] = torrent_details['hashString']
+                if self.files_complete(torrent_details):
+                    self.cache_files(torrent_details['hashString'], torrent_details['files'])
+            self.upgrade_torrent(torrent_details)
+            self.torrent_details_cache = torrent_details
+            if torrent_details['id'] == self.details_id:
+                self.prepare_details_request()  # stop asking for what has arrived
+            if answer.has_key('peers') and torrent_details.has_key('hashString') \
+                    and torrent_details.has_key('totalSize'):
+                self.upgrade_peerlist()
+
+        elif response['tag'] in (self.TAG_SESSION_STATS, self.TAG_SESSION_GET):
+            self.status_cache = dict(self.status_cache)
             self.status_cache.update(response['arguments'])
 
+        self.dirty = True
         return response['tag']
 
+    def receive_torrent(self, t):
+        """Turn a torrent of the list into what's cached while the rest is still coming in."""
+        # published torrents must not change, so update a copy
+        if not self.torrentlist_is_full and self.torrent_index.has_key(t['id']):
+            merged = dict(self.torrent_index[t['id']])
+            merged.update(t)
+            if not t.has_key('trackerStats'):
+                merged.pop('trackerStats', None)  # no longer requested, seeders are unknown now
+            t = merged
+        self.upgrade_torrent(t)
+        return t
+
+    def merge_torrentlist(self, torrents, removed):
+        for t in torrents:
+            self.torrent_index[t['id']] = t
+
+        for id in removed:
+            self.torrent_index.pop(id, None)
+
+    def upgrade_torrent(self, t):
+        t['uploadRatio'] = round(float(t['uploadRatio']), 2)
+        t['percentDone'] = percent(float(t['sizeWhenDone']),
+                                   float(t['haveValid'] + t['haveUnchecked']))
+        t['available'] = t['desiredAvailable'] + t['haveValid'] + t['haveUnchecked']
+        if t['downloadDir'][-1] != '/':
+            t['downloadDir'] += '/'
+        if t.has_key('trackerStats'):
+            try:
+                t['seeders']  = max(map(lambda x: x['seederCount'],  t['trackerStats']))
+                t['leechers'] = max(map(lambda x: x['leecherCount'], t['trackerStats']))
+            except ValueError:
+                t['seeders']  = t['leechers'] = -1
+        else:
+            t['seeders']  = t['leechers'] = -1
+
     def upgrade_peerlist(self):
         for index,peer in enumerate(self.torrent_details_cache['peers']):
             ip = peer['address']
@@ -446,39 +1426,125 @@ class Transmission:
     def get_rpc_version(self):
         return self.rpc_version
 
+    def get_address(self):
+        return "%s:%s" % (self.host, self.port)
+
+    def get_connection_stats(self):
+        return self.pool.get_stats()
+
     def get_global_stats(self):
-        return self.status_cache
+        return self.snapshot.stats
+
+    def get_stale_since(self):
+        """Time of the last answer if the daemon stopped answering since, else None."""
+        return self.snapshot.stale_since
+
+    def get_connection_error(self):
+        """Why the daemon can't be reached while reconnecting, else None."""
+        return self.snapshot.error
 
     def get_torrent_list(self, sort_orders):
-        try:
-            for sort_order in sort_orders:
-                if isinstance(self.torrent_cache[0][sort_order['name']], (str, unicode)):
-                    self.torrent_cache.sort(key=lambda x: x[sort_order['name']].lower(),
-                                            reverse=sort_order['reverse'])
-                else:
-                    self.torrent_cache.sort(key=lambda x: x[sort_order['name']],
-                                            reverse=sort_order['reverse'])
-        except IndexError:
-            return []
-        return self.torrent_cache
+        return self.sorter.sort(self.snapshot.torrents, sort_orders)
+
+    def set_list_view(self, names):
+        """Fetch only the list fields that are needed to show, sort and filter by <names>."""
+        fields = set(self.LIST_FIELDS_BASE)
+        for name in names:
+            if self.LIST_FIELDS_FOR.has_key(name):
+                fields.update(self.LIST_FIELDS_FOR[name])
+            elif name in self.LIST_FIELDS:
+                fields.add(name)
+        fields = sorted(fields)
+        if fields == self.list_fields:
+            return
 
-    def get_torrent_by_id(self, id):
-        i = 0
-        while self.torrent_cache[i]['id'] != id:  i += 1
-        if self.torrent_cache[i]['id'] == id:
-            return self.torrent_cache[i]
+        grown = not set(self.list_fields).issuperset(fields)
+        self.list_fields = fields
+        if grown:
+            # cached torrents lack the new fields, so they must be fetched
+            # before the list is drawn again
+            self.call_and_wait(self.refetch_torrentlist)
         else:
-            return None
+            self.call(self.refetch_torrentlist, False)
+
+    def refetch_torrentlist(self, now=True):
+        if now:
+            self.requests['torrent-list'].cancel()
+            self.last_full_sync = 0
+            self.prepare_torrentlist_request()
+            self.fetch('torrent-list')
+        elif not self.requests['torrent-list'].open_request:
+            self.prepare_torrentlist_request()
+
+    def get_torrents_by_ids(self, ids):
+        return [self.snapshot.index[id] for id in ids if self.snapshot.index.has_key(id)]
+
+    def get_torrent_by_id(self, id):
+        return self.snapshot.index.get(id)
 
 
     def get_torrent_details(self):
-        return self.torrent_details_cache
+        return self.snapshot.details
     def set_torrent_details_id(self, id):
         if id < 0:
-            self.requests['torrent-details'] = TransmissionRequest(self.host, self.port, self.path)
+            self.call(self.change_torrent_details, id)
         else:
-            self.requests['torrent-details'].set_request_data('torrent-get', self.TAG_TORRENT_DETAILS,
-                                                              {'ids':id, 'fields': self.DETAIL_FIELDS})
+            self.call_and_wait(self.change_torrent_details, id)
+
+    def change_torrent_details(self, id):
+        self.requests['torrent-details'].cancel()
+        self.intervals['torrent-details'] = self.POLL_INTERVALS['torrent-details'][0]
+        self.details_id = id
+        if id < 0:
+            self.requests['torrent-details'] = TransmissionRequest(self.pool, self.path)
+        else:
+            self.prepare_details_request()
+            self.fetch('torrent-details')
+
+    def files_complete(self, details):
+        """Whether <details> list all files; magnet links have none until their metadata arrives."""
+        files = details.get('files')
+        return bool(files) and len(files) == len(details.get('fileStats', files))
+
+    def missing_static_fields(self):
+        """Static fields of details_id that haven't been received yet.  They are
+        asked for until they arrive, even if the first answer timed out."""
+        details = self.torrent_details_cache
+        if details.get('id') == self.details_id:
+            fields = [f for f in self.DETAIL_FIELDS_STATIC if not details.has_key(f)]
+            lack_files = not self.files_complete(details)
+        else:
+            fields = list(self.DETAIL_FIELDS_STATIC)
+            lack_files = not self.files_cache.has_key(self.hash_strings.get(self.details_id))
+        if lack_files:
+            fields.append('files')
+        return fields
+
+    def cache_files(self, hash_string, files):
+        if self.files_cache.has_key(hash_string):
+            self.files_cache_order.remove(hash_string)
+        elif len(self.files_cache_order) >= self.FILES_CACHE_SIZE:
+            del self.files_cache[self.files_cache_order.pop(0)]
+        self.files_cache[hash_string] = files
+        self.files_cache_order.append(hash_string)
+
+    def set_details_view(self, view):
+        """Poll only the details needed to show <view>, see DETAIL_FIELDS_FOR."""
+        if view != self.details_view:
+            self.details_view = view
+            self.call_and_wait(self.refetch_torrent_details)
+
+    def refetch_torrent_details(self):
+        if self.details_id < 0:
+            return
+        self.requests['torrent-details'].cancel()
+        self.prepare_details_request()
+        self.fetch('torrent-details')
+
+    def prepare_details_request(self):
+        fields = self.LIST_FIELDS + self.DETAIL_FIELDS_FOR[self.details_view] + self.missing_static_fields()
+        self.requests['torrent-details'].set_request_data('torrent-get', self.TAG_TORRENT_DETAILS,
+                                                          {'ids':self.details_id, 'fields':fields})
 
     def get_hosts(self):
         return self.hosts_cache
@@ -487,13 +1553,91 @@ class Transmission:
         return self.geo_ips_cache
 
 
-    def set_option(self, option_name, option_value):
-        request = TransmissionRequest(self.host, self.port, self.path, 'session-set', 1, {option_name: option_value})
+    def queue_command(self, method, arguments, error_msg=''):
+        """Submit command without waiting for the daemon to confirm it."""
+        # returns as soon as the expected change is published
+        self.call_and_wait(self.send_command, method, arguments, error_msg)
+
+    def send_command(self, method, arguments, error_msg):
+        self.apply_command(method, arguments)
+        tag = self.next_command_tag
+        self.next_command_tag += 1
+        request = TransmissionRequest(self.pool, self.path, method, tag, arguments)
+        self.queued_commands.append((request, error_msg))
+
+    def apply_command(self, method, arguments):
+        """Change cached data the way the daemon is expected to."""
+        ids = arguments.get('ids', [])
+        # published torrents must not change, so work on copies
+        torrents = [dict(self.torrent_index[id]) for id in ids if self.torrent_index.has_key(id)]
+        for t in torrents:
+            self.torrent_index[t['id']] = t
+        details = self.torrent_details_cache and self.torrent_details_cache['id'] in ids
+        if details:
+            self.torrent_details_cache = dict(self.torrent_details_cache)
+            torrents.append(self.torrent_details_cache)
+        self.dirty = True
+
+        if method == 'torrent-stop':
+            for t in torrents:
+                t.update({'status':Transmission.STATUS_STOPPED, 'rateDownload':0, 'rateUpload':0})
+        elif method == 'torrent-start':
+            for t in torrents:
+                if t['status'] == Transmission.STATUS_STOPPED:
+                    t['status'] = (Transmission.STATUS_SEED, Transmission.STATUS_DOWNLOAD)[t['percentDone'] < 100]
+        elif method == 'torrent-verify':
+            for t in torrents:
+                t['status'] = Transmission.STATUS_CHECK_WAIT
+        elif method == 'torrent-set-location':
+            for t in torrents:
+                t['downloadDir'] = arguments['location'].rstrip('/') + '/'
+        elif method == 'torrent-remove':
+            self.merge_torrentlist([], ids)
+        elif method == 'torrent-set':
+            for t in torrents:
+                for key, value in arguments.items():
+                    if key != 'ids' and value != None and t.has_key(key):
+                        t[key] = value
+            if details and self.torrent_details_cache.has_key('wanted'):
+                t = self.torrent_details_cache
+                t['wanted'], t['priorities'] = list(t['wanted']), list(t['priorities'])
+                for num in arguments.get('files-wanted', []):     t['wanted'][num] = True
+                for num in arguments.get('files-unwanted', []):   t['wanted'][num] = False
+                for num in arguments.get('priority-high', []):    t['priorities'][num] = 1
+                for num in arguments.get('priority-normal', []):  t['priorities'][num] = 0
+                for num in arguments.get('priority-low', []):     t['priorities'][num] = -1
+        elif method == 'session-set':
+            self.status_cache = dict(self.status_cache)
+            self.status_cache.update(arguments)
+
+    def pass_through(self, method, arguments, tag, changes=True):
+        """Send a request as it is and return the daemon's answer."""
+        answer = []
+        self.call_and_wait(self.send_and_wait, method, arguments, tag, changes, answer)
+        return answer[0]
+
+    def send_and_wait(self, method, arguments, tag, changes, answer):
+        request = TransmissionRequest(self.pool, self.path)
+        request.set_request_data(method, tag, arguments)
         request.send_request()
-        self.wait_for_status_update()
+        answer.append(request.get_response())
+        if changes:
+            self.refresh_after_command()
 
+    def get_command_errors(self):
+        errors = []
+        try:
+            while True:
+                errors.append(self.command_errors.get_nowait())
+        except Queue.Empty:
+            return errors
+
+
+    def set_option(self, option_name, option_value):
+        self.queue_command('session-set', {option_name: option_value})
 
-    def set_rate_limit(self, direction, new_limit, torrent_id=-1):
+
+    def set_rate_limit(self, direction, new_limit, torrent_ids=[]):
         data = dict()
         if new_limit <= -1:
             new_limit     = None
@@ -501,22 +1645,20 @@ class Transmission:
         else:
             limit_enabled = True
 
-        if torrent_id < 0:
+        if not torrent_ids:
             type = 'session-set'
             data['speed-limit-'+direction]            = new_limit
             data['speed-limit-'+direction+'-enabled'] = limit_enabled
         else:
             type = 'torrent-set'
-            data['ids'] = [torrent_id]
+            data['ids'] = torrent_ids
             data[direction+'loadLimit']   = new_limit
             data[direction+'loadLimited'] = limit_enabled
 
-        request = TransmissionRequest(self.host, self.port, self.path, type, 1, data)
-        request.send_request()
-        self.wait_for_torrentlist_update()
+        self.queue_command(type, data)
 
 
-    def set_seed_ratio(self, ratio, torrent_id=-1):
+    def set_seed_ratio(self, ratio, torrent_ids):
         data = dict()
         if ratio == -1:
             ratio = None
@@ -529,135 +1671,105 @@ class Transmission:
         else:
             return
 
-        data['ids']            = [torrent_id]
+        data['ids']            = torrent_ids
         data['seedRatioLimit'] = ratio
         data['seedRatioMode']  = mode
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-set', 1, data)
-        request.send_request()
-        self.wait_for_torrentlist_update()
+        self.queue_command('torrent-set', data)
 
 
-    def increase_bandwidth_priority(self, torrent_id):
-        torrent = self.get_torrent_by_id(torrent_id)
-        if torrent == None or torrent['bandwidthPriority'] >= 1:
-            return False
-        else:
-            new_priority = torrent['bandwidthPriority'] + 1
-            request = TransmissionRequest(self.host, self.port, self.path, 'torrent-set', 1,
-                                          {'ids': [torrent_id], 'bandwidthPriority':new_priority})
-            request.send_request()
-            self.wait_for_torrentlist_update()
+    def increase_bandwidth_priority(self, torrent_ids):
+        self.change_bandwidth_priority(torrent_ids, 1)
 
-    def decrease_bandwidth_priority(self, torrent_id):
-        torrent = self.get_torrent_by_id(torrent_id)
-        if torrent == None or torrent['bandwidthPriority'] <= -1:
-            return False
-        else:
-            new_priority = torrent['bandwidthPriority'] - 1
-            request = TransmissionRequest(self.host, self.port, self.path, 'torrent-set', 1,
-                                          {'ids': [torrent_id], 'bandwidthPriority':new_priority})
-            request.send_request()
-            self.wait_for_torrentlist_update()
+    def decrease_bandwidth_priority(self, torrent_ids):
+        self.change_bandwidth_priority(torrent_ids, -1)
+
+    def change_bandwidth_priority(self, torrent_ids, step):
+        # torrents may have different priorities, so group them by their new one
+        new_priorities = dict()
+        for torrent_id in torrent_ids:
+            torrent = self.get_torrent_by_id(torrent_id)
+            if torrent == None or not -1 <= torrent['bandwidthPriority'] + step <= 1:
+                continue
+            new_priority = torrent['bandwidthPriority'] + step
+            new_priorities.setdefault(new_priority, []).append(torrent_id)
+
+        for new_priority, ids in new_priorities.items():
+            self.queue_command('torrent-set', {'ids': ids, 'bandwidthPriority':new_priority})
 
 
     def toggle_turtle_mode(self):
-        self.set_option('alt-speed-enabled', not self.status_cache['alt-speed-enabled'])
+        self.set_option('alt-speed-enabled', not self.snapshot.stats['alt-speed-enabled'])
 
 
     def add_torrent(self, location):
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-add', 1, {'filename': location})
-        request.send_request()
-        response = request.get_response()
-        if response['result'] != 'success':
-            return response['result']
-        else:
-            return ''
+        self.queue_command('torrent-add', {'filename': location},
+                           "Couldn't add torrent \"%s\":" % location)
 
-    def stop_torrent(self, id):
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-stop', 1, {'ids': [id]})
-        request.send_request()
-        self.wait_for_torrentlist_update()
+    def stop_torrents(self, ids):
+        self.queue_command('torrent-stop', {'ids': ids})
 
-    def start_torrent(self, id):
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-start', 1, {'ids': [id]})
-        request.send_request()
-        self.wait_for_torrentlist_update()
+    def start_torrents(self, ids):
+        self.queue_command('torrent-start', {'ids': ids})
 
-    def verify_torrent(self, id):
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-verify', 1, {'ids': [id]})
-        request.send_request()
-        self.wait_for_torrentlist_update()
+    def verify_torrents(self, ids):
+        self.queue_command('torrent-verify', {'ids': ids})
 
-    def reannounce_torrent(self, id):
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-reannounce', 1, {'ids': [id]})
-        request.send_request()
-        self.wait_for_torrentlist_update()
+    def reannounce_torrents(self, ids):
+        self.queue_command('torrent-reannounce', {'ids': ids})
 
-    def move_torrent(self, torrent_id, new_location):
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-set-location', 1,
-                                      {'ids': torrent_id, 'location': new_location, 'move': True})
-        request.send_request()
-        self.wait_for_torrentlist_update()
+    def move_torrents(self, ids, new_location):
+        self.queue_command('torrent-set-location', {'ids': ids, 'location': new_location, 'move': True},
+                           "Couldn't move torrent:")
 
-    def remove_torrent(self, id):
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-remove', 1, {'ids': [id]})
-        request.send_request()
-        self.wait_for_torrentlist_update()
+    def remove_torrents(self, ids):
+        self.queue_command('torrent-remove', {'ids': ids})
 
-    def remove_torrent_local_data(self, id):
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-remove', 1, {'ids': [id], 'delete-local-data':True})
-        request.send_request()
-        self.wait_for_torrentlist_update()
+    def remove_torrents_local_data(self, ids):
+        self.queue_command('torrent-remove', {'ids': ids, 'delete-local-data':True},
+                           "Couldn't remove torrent:")
 
     def add_torrent_tracker(self, id, tracker):
         data = { 'ids' : [id],
                  'trackerAdd' : [tracker] }
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-set', 1, data)
-        request.send_request()
-        response = request.get_response()
-        return response['result'] if response['result'] != 'success' else ''
+        self.queue_command('torrent-set', data, "Couldn't add tracker:")
 
     def remove_torrent_tracker(self, id, tracker):
         data = { 'ids' : [id],
                  'trackerRemove' : [tracker] }
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-set', 1, data)
-        request.send_request()
-        response = request.get_response()
-        self.wait_for_torrentlist_update()
-        return response['result'] if response['result'] != 'success' else ''
+        self.queue_command('torrent-set', data, "Couldn't remove tracker:")
 
     def increase_file_priority(self, file_nums):
+        details = self.snapshot.details
         file_nums = list(file_nums)
         ref_num = file_nums[0]
         for num in file_nums:
-            if not self.torrent_details_cache['wanted'][num]:
+            if not details['wanted'][num]:
                 ref_num = num
                 break
-            elif self.torrent_details_cache['priorities'][num] < \
-                    self.torrent_details_cache['priorities'][ref_num]:
+            elif details['priorities'][num] < details['priorities'][ref_num]:
                 ref_num = num
-        current_priority = self.torrent_details_cache['priorities'][ref_num]
-        if not self.torrent_details_cache['wanted'][ref_num]:
-            self.set_file_priority(self.torrent_details_cache['id'], file_nums, 'low')
+        current_priority = details['priorities'][ref_num]
+        if not details['wanted'][ref_num]:
+            self.set_file_priority(details['id'], file_nums, 'low')
         elif current_priority == -1:
-            self.set_file_priority(self.torrent_details_cache['id'], file_nums, 'normal')
+            self.set_file_priority(details['id'], file_nums, 'normal')
         elif current_priority == 0:
-            self.set_file_priority(self.torrent_details_cache['id'], file_nums, 'high')
+            self.set_file_priority(details['id'], file_nums, 'high')
 
     def decrease_file_priority(self, file_nums):
+        details = self.snapshot.details
         file_nums = list(file_nums)
         ref_num = file_nums[0]
         for num in file_nums:
-            if self.torrent_details_cache['priorities'][num] > \
-                    self.torrent_details_cache['priorities'][ref_num]:
+            if details['priorities'][num] > details['priorities'][ref_num]:
                 ref_num = num
-        current_priority = self.torrent_details_cache['priorities'][ref_num]
+        current_priority = details['priorities'][ref_num]
         if current_priority >= 1:
-            self.set_file_priority(self.torrent_details_cache['id'], file_nums, 'normal')
+            self.set_file_priority(details['id'], file_nums, 'normal')
         elif current_priority == 0:
-            self.set_file_priority(self.torrent_details_cache['id'], file_nums, 'low')
+            self.set_file_priority(details['id'], file_nums, 'low')
         elif current_priority == -1:
-            self.set_file_priority(self.torrent_details_cache['id'], file_nums, 'off')
+            self.set_file_priority(details['id'], file_nums, 'off')
 
 
     def set_file_priority(self, torrent_id, file_nums, priority):
@@ -667,30 +1779,16 @@ class Transmission:
         else:
             request_data['files-wanted'] = file_nums
             request_data['priority-' + priority] = file_nums
-        request = TransmissionRequest(self.host, self.port, self.path, 'torrent-set', 1, request_data)
-        request.send_request()
-        self.wait_for_details_update()
+        self.queue_command('torrent-set', request_data)
 
     def get_file_priority(self, torrent_id, file_num):
-        priority = self.torrent_details_cache['priorities'][file_num]
-        if not self.torrent_details_cache['wanted'][file_num]: return 'off'
+        priority = self.snapshot.details['priorities'][file_num]
+        if not self.snapshot.details['wanted'][file_num]: return 'off'
         elif priority <= -1: return 'low'
         elif priority == 0:  return 'normal'
         elif priority >= 1:  return 'high'
         return '?'
 
-    def wait_for_torrentlist_update(self):
-        self.wait_for_update(7)
-    def wait_for_details_update(self):
-        self.wait_for_update(77)
-    def wait_for_status_update(self):
-        self.wait_for_update(22)
-    def wait_for_update(self, update_id):
-        self.update(0) # send request
-        while True:    # wait for response
-            if self.update(0, update_id): break
-            time.sleep(0.1)
-
     def get_status(self, torrent):
         if torrent['status'] == Transmission.STATUS_STOPPED:
             status = 'paused'
@@ -723,12 +1821,831 @@ class Transmission:
 # End of Class Transmission
 
 
+# Compare the torrents of two snapshots.  Published torrents never change,
+# so a torrent that is still the same object is still the same torrent.
+def torrent_changes(old, old_objects, torrents):
+    """Return the id()s of <torrents>, the torrents that are not in <old>
+    and the ones of <old> that are gone.  <old_objects> are the id()s of <old>."""
+    objects = set(map(id, torrents))
+    changed = [t for t in torrents if id(t) not in old_objects]
+    gone    = [t for t in old if id(t) not in objects]
+    return objects, changed, gone
+
+
+# Sort key component that orders its value from high to low.
+class Descending(object):
+    __slots__ = ['value']
+    def __init__(self, value): self.value = value
+    def __eq__(self, other):   return self.value == other.value
+    def __ne__(self, other):   return self.value != other.value
+    def __lt__(self, other):   return self.value > other.value
+    def __le__(self, other):   return self.value >= other.value
+    def __gt__(self, other):   return self.value < other.value
+    def __ge__(self, other):   return self.value <= other.value
+
+# Sorts the torrents of consecutive snapshots.  Each torrent gets one key
+# for all sort orders, computed again only when the torrent changed.  If
+# the keys of just a few torrents changed, those are moved into place
+# with bisect instead of sorting everything again.
+class TorrentSorter:
+    def __init__(self):
+        self.sort_orders = None
+        self.source = ()         # torrents <result> was made from
+        self.source_objects = set()  # id() of each of them
+        self.result = TorrentList()
+        self.keys = dict()       # torrent id -> (torrent, key)
+        self.sorted_keys = []    # keys in the order of <result>
+
+    def make_key(self, t):
+        # the last sort order is the most significant one; ids break ties
+        key = []
+        for sort_order in reversed(self.sort_orders):
+            value = t[sort_order['name']]
+            if isinstance(value, basestring):
+                value = value.lower()
+            if sort_order['reverse']:
+                if isinstance(value, (int, long, float)):
+                    value = -value
+                else:
+                    value = Descending(value)
+            key.append(value)
+        key.append(t['id'])
+        return tuple(key)
+
+    def sort(self, torrents, sort_orders):
+        if sort_orders != self.sort_orders:
+            self.sort_orders = [dict(sort_order) for sort_order in sort_orders]
+            self.source = ()
+            self.source_objects = set()
+            self.keys = dict()
+        if torrents is self.source:
+            return self.result
+
+        objects, changed, gone = torrent_changes(self.source, self.source_objects, torrents)
+        moved    = []  # (old key or None, new key, torrent)
+        replaced = []  # (key, torrent) that changed but stay where they are
+        old_keys = dict((t['id'], self.keys.pop(t['id'])[1]) for t in gone)
+        for t in changed:
+            key = self.make_key(t)
+            old = old_keys.pop(t['id'], None)
+            self.keys[t['id']] = (t, key)
+            if old == key:
+                replaced.append((key, t))
+            else:
+                moved.append((old, key, t))
+        removed = old_keys.values()
+
+        if (len(moved) + len(removed)) * 10 > len(torrents):
+            items = sorted([(key, t) for t, key in self.keys.values()])
+            self.sorted_keys = [key for key, t in items]
+            order = [t for key, t in items]
+        else:
+            order = list(self.result)
+            for key, t in replaced:
+                order[bisect.bisect_left(self.sorted_keys, key)] = t
+            for key in removed + [old for old, key, t in moved if old]:
+                i = bisect.bisect_left(self.sorted_keys, key)
+                del self.sorted_keys[i]
+                del order[i]
+            for old, key, t in moved:
+                i = bisect.bisect_left(self.sorted_keys, key)
+                self.sorted_keys.insert(i, key)
+                order.insert(i, t)
+
+        self.source = torrents
+        self.source_objects = objects
+        self.result = TorrentList(order)
+        return self.result
+
+
+# Filter queries like "ratio<1 and tracker~foo and size>10G" are compiled
+# once into a predicate on torrents.  Fields a query can test:
+#   name -> (list field it needs, kind of value, value of a torrent)
+FILTER_FIELDS = {
+    'name':     ('name',           'text',    lambda t: t['name']),
+    'dir':      ('downloadDir',    'text',    lambda t: t['downloadDir']),
+    'error':    ('errorString',    'text',    lambda t: t['errorString']),
+    'tracker':  ('trackerStats',   'texts',   lambda t: [s['announce'] for s in t['trackerStats']]),
+    'status':   ('status',         'status',  lambda t: t['status']),
+    'progress': ('percentDone',    'number',  lambda t: t['percentDone']),
+    'ratio':    ('uploadRatio',    'number',  lambda t: t['uploadRatio']),
+    'size':     ('sizeWhenDone',   'bytes',   lambda t: t['sizeWhenDone']),
+    'uploaded': ('uploadedEver',   'bytes',   lambda t: t['uploadedEver']),
+    'down':     ('rateDownload',   'bytes',   lambda t: t['rateDownload']),
+    'up':       ('rateUpload',     'bytes',   lambda t: t['rateUpload']),
+    'eta':      ('eta',            'seconds', lambda t: t['eta']),
+    'peers':    ('peersConnected', 'number',  lambda t: t['peersConnected']),
+    'seeders':  ('seeders',        'number',  lambda t: t['seeders']),
+    'leechers': ('leechers',       'number',  lambda t: t['leechers']),
+    'id':       ('id',             'number',  lambda t: t['id']) }
+
+# values are looked up when a filter is tested, old servers change them on connect
+FILTER_STATUSES = { 'stopped':'STATUS_STOPPED', 'check-wait':'STATUS_CHECK_WAIT',
+                    'checking':'STATUS_CHECK', 'download-wait':'STATUS_DOWNLOAD_WAIT',
+                    'downloading':'STATUS_DOWNLOAD', 'seed-wait':'STATUS_SEED_WAIT',
+                    'seeding':'STATUS_SEED' }
+FILTER_UNITS = { 'bytes':   { 'k':1024, 'm':1024**2, 'g':1024**3, 't':1024**4 },
+                 'seconds': { 's':1, 'm':60, 'h':3600, 'd':86400 } }
+FILTER_OPERATORS = { '<':operator.lt, '<=':operator.le, '>':operator.gt, '>=':operator.ge,
+                     '=':operator.eq, '!=':operator.ne }
+FILTER_TOKENS = re.compile(r'\s*(?:([()]|<=|>=|!=|!~|[<>=~])|"([^"]*)"|\'([^\']*)\'|([^\s()<>=!~"\']+))')
+
+class FilterQuery:
+    def __init__(self, query):
+        self.query  = query
+        self.fields = set()  # names for Transmission.set_list_view()
+        self.tokens = []     # (symbol, word, quoted word), two of them None
+        index = 0
+        query = query.rstrip()
+        while index < len(query):
+            match = FILTER_TOKENS.match(query, index)
+            if not match:
+                raise ValueError("Unexpected character: %s" % query[index:].lstrip()[0])
+            quoted = match.group(2)
+            if quoted is None:
+                quoted = match.group(3)
+            self.tokens.append((match.group(1), match.group(4), quoted))
+            index = match.end()
+
+        self.position = 0
+        self.test = self.parse_or()
+        if self.position < len(self.tokens):
+            symbol, word, quoted = self.tokens[self.position]
+            raise ValueError("Unexpected '%s'" % (symbol or word or quoted))
+
+    def peek_keyword(self, keyword):
+        if self.position < len(self.tokens) and self.tokens[self.position][1] is not None \
+                and self.tokens[self.position][1].lower() == keyword:
+            self.position += 1
+            return True
+        return False
+
+    def next_token(self, expected):
+        if self.position >= len(self.tokens):
+            raise ValueError("Query ends where %s was expected" % expected)
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    def parse_or(self):
+        test = self.parse_and()
+        while self.peek_keyword('or'):
+            test = (lambda a, b: lambda t: a(t) or b(t))(test, self.parse_and())
+        return test
+
+    def parse_and(self):
+        test = self.parse_not()
+        while self.peek_keyword('and'):
+            test = (lambda a, b: lambda t: a(t) and b(t))(test, self.parse_not())
+        return test
+
+    def parse_not(self):
+        if self.peek_keyword('not'):
+            test = self.parse_not()
+            return lambda t: not test(t)
+        return self.parse_term()
+
+    def parse_term(self):
+        symbol, word, quoted = self.next_token('a filter')
+        if symbol == '(':
+            test = self.parse_or()
+            if self.next_token("')'")[0] != ')':
+                raise ValueError("Missing ')'")
+            return test
+        elif symbol:
+            raise ValueError("Unexpected '%s'" % symbol)
+
+        name = (word or quoted).lower()
+        if self.position < len(self.tokens) and self.tokens[self.position][0] not in (None, '(', ')'):
+            return self.parse_comparison(name)
+        if not TorrentFilter.PREDICATES.has_key(name):
+            raise ValueError("Unknown filter: %s" % name)
+        self.fields.add(name)
+        return TorrentFilter.PREDICATES[name]
+
+    def parse_comparison(self, name):
+        if not FILTER_FIELDS.has_key(name):
+            raise ValueError("Unknown field: %s" % name)
+        field, kind, get = FILTER_FIELDS[name]
+        self.fields.add(field)
+        op = self.next_token('a comparison')[0]
+        symbol, word, quoted = self.next_token('a value')
+        value = (word, quoted)[word is None]
+        if value is None:
+            raise ValueError("Missing value after %s%s" % (name, op))
+
+        if kind in ('text', 'texts'):
+            value = value.lower()
+            if op in ('~', '!~'):
+                match = lambda s: value in s.lower()
+            elif op in ('=', '!='):
+                match = lambda s: value == s.lower()
+            else:
+                raise ValueError("Cannot compare %s with '%s'" % (name, op))
+            if kind == 'texts':
+                test = lambda t: any(match(s) for s in get(t))
+            else:
+                test = lambda t: match(get(t))
+            if op.startswith('!'):
+                return lambda t: not test(t)
+            return test
+
+        if op not in FILTER_OPERATORS:
+            raise ValueError("Cannot compare %s with '%s'" % (name, op))
+        compare = FILTER_OPERATORS[op]
+        if kind == 'status':
+            status = self.parse_status(value)
+            return lambda t: compare(get(t), getattr(Transmission, status))
+        value = self.parse_number(kind, value)
+        return lambda t: compare(get(t), value)
+
+    def parse_status(self, value):
+        if not FILTER_STATUSES.has_key(value.lower()):
+            raise ValueError("Unknown status: %s (one of %s)" %
+                             (value, ', '.join(sorted(FILTER_STATUSES.keys()))))
+        return FILTER_STATUSES[value.lower()]
+
+    def parse_number(self, kind, value):
+        units = FILTER_UNITS.get(kind, {})
+        number = value.lower()
+        if kind == 'bytes' and number.endswith('b'):
+            number = number[:-1]
+        factor = 1
+        if number and units.has_key(number[-1]):
+            factor = units[number[-1]]
+            number = number[:-1]
+        try:
+            return float(number) * factor
+        except ValueError:
+            raise ValueError("Not a number: %s" % value)
+
+filter_queries = dict()  # query string -> FilterQuery
+def compile_filter_query(query):
+    """Return <query> compiled into a FilterQuery; raise ValueError if it's invalid."""
+    if not filter_queries.has_key(query):
+        filter_queries[query] = FilterQuery(query)
+    return filter_queries[query]
+
+
+# Named filters and filter queries for the torrent list.  Each filter that
+# has been used keeps the ids of the torrents it matches and only tests the
+# torrents that changed since the last list, so showing the matching
+# torrents or all the others costs the same.
+class TorrentFilter:
+    PREDICATES = {
+        'downloading': lambda t: t['rateDownload'] > 0,
+        'uploading':   lambda t: t['rateUpload'] > 0,
+        'paused':      lambda t: t['status'] == Transmission.STATUS_STOPPED,
+        'seeding':     lambda t: t['status'] == Transmission.STATUS_SEED \
+                                 or t['status'] == Transmission.STATUS_SEED_WAIT,
+        'incomplete':  lambda t: t['percentDone'] < 100,
+        'active':      lambda t: t['peersGettingFromUs'] > 0 \
+                                 or t['peersSendingToUs'] > 0 \
+                                 or t['status'] == Transmission.STATUS_CHECK,
+        'verifying':   lambda t: t['status'] == Transmission.STATUS_CHECK \
+                                 or t['status'] == Transmission.STATUS_CHECK_WAIT,
+        }
+
+    def __init__(self):
+        self.source = ()         # torrents the id sets are up to date with
+        self.source_objects = set()
+        self.matches = dict()    # filter query -> (predicate, ids of matching torrents)
+        self.view = None         # (torrents, name, inverse) of <result>
+        self.result = TorrentList()
+
+    def test(self, predicate, t):
+        try:
+            return predicate(t)
+        except KeyError:
+            return False  # field not fetched yet
+
+    def update(self, torrents):
+        objects, changed, gone = torrent_changes(self.source, self.source_objects, torrents)
+        for predicate, ids in self.matches.itervalues():
+            for t in gone:
+                ids.discard(t['id'])
+            for t in changed:
+                if self.test(predicate, t):
+                    ids.add(t['id'])
+        self.source = torrents
+        self.source_objects = objects
+
+    def filter(self, torrents, name, inverse=False):
+        """Return the torrents that match filter query <name> or, if <inverse>, all others."""
+        if not name:
+            return (torrents, TorrentList())[inverse]
+        if self.view and self.view[0] is torrents and self.view[1:] == (name, inverse):
+            return self.result
+
+        if torrents is not self.source:
+            self.update(torrents)
+        if not self.matches.has_key(name):
+            # forget earlier queries, the named filters are cheap to keep
+            for query in self.matches.keys():
+                if not self.PREDICATES.has_key(query):
+                    del self.matches[query]
+            predicate = compile_filter_query(name).test
+            self.matches[name] = (predicate, set([t['id'] for t in torrents if self.test(predicate, t)]))
+        ids = self.matches[name][1]
+        if inverse:
+            self.result = TorrentList([t for t in torrents if t['id'] not in ids])
+        else:
+            self.result = TorrentList([t for t in torrents if t['id'] in ids])
+        self.view = (torrents, name, inverse)
+        return self.result
+
+
+# Finds torrents by a part of their name for the search dialog.  The
+# lowered names are kept up to date with the torrents that changed and
+# are searched as one text with str.find, which is only joined again
+# after names changed.  A query that contains an earlier one only tests
+# the torrents that matched that one.
+class TorrentSearch:
+    def __init__(self):
+        self.source = ()         # torrents the names are up to date with
+        self.source_objects = set()
+        self.names = dict()      # torrent id -> (name, lowered name)
+        self.text = None         # all lowered names, None if outdated
+        self.ids = []            # torrent id of each name in <text>
+        self.starts = []         # offset of each name in <text>
+        self.results = dict()    # query -> ids of matching torrents
+
+    def update(self, torrents):
+        objects, changed, gone = torrent_changes(self.source, self.source_objects, torrents)
+        removed = dict([(t['id'], self.names.pop(t['id'])) for t in gone])
+        for t in changed:
+            old = removed.pop(t['id'], None)
+            if old and old[0] == t['name']:
+                self.names[t['id']] = old
+            else:
+                self.names[t['id']] = (t['name'], t['name'].lower())
+                self.text = None
+        if removed:
+            self.text = None
+        if self.text is None:
+            self.ids = self.names.keys()
+            self.starts = []
+            offset = 0
+            for id in self.ids:
+                self.starts.append(offset)
+                offset += len(self.names[id][1]) + 1
+            self.text = '\n'.join([self.names[id][1] for id in self.ids])
+            self.results = dict()
+        self.source = torrents
+        self.source_objects = objects
+
+    def find(self, keyword):
+        if len(keyword) < 3:
+            # most names match, so jumping from match to match is slower
+            return [id for id, (name, lowered) in self.names.iteritems() if keyword in lowered]
+        ids = []
+        i = self.text.find(keyword)
+        while i >= 0:
+            n = bisect.bisect_right(self.starts, i) - 1
+            ids.append(self.ids[n])
+            if n + 1 == len(self.starts):
+                break
+            i = self.text.find(keyword, self.starts[n + 1])
+        return ids
+
+    def search(self, torrents, keyword):
+        """Return the torrents of <torrents> whose name contains <keyword>, in the same order."""
+        if torrents is not self.source:
+            self.update(torrents)
+        keyword = keyword.lower()
+        if not self.results.has_key(keyword):
+            narrower = [query for query in self.results if query in keyword]
+            if narrower:
+                query = max(narrower, key=len)
+                self.results[keyword] = [id for id in self.results[query] if keyword in self.names[id][1]]
+            else:
+                self.results[keyword] = self.find(keyword)
+        return [torrents[i] for i in sorted(map(torrents.position, self.results[keyword]))]
+
+
+# Several daemons that look like one Transmission to the interface.  Each
+# of them is polled by its own worker; all workers wake up the interface
+# through the same pipe.  Torrent ids are made unique by interleaving them:
+# id * number of daemons + index of the daemon.
+class MultiTransmission:
+    # summed up over all daemons in get_global_stats()
+    SUMMED_STATS = ['downloadSpeed', 'uploadSpeed', 'torrentCount', 'activeTorrentCount', 'pausedTorrentCount']
+
+    def __init__(self, connections):
+        """<connections> is a list of (name, section, host, port, path, username, password, ssl)."""
+        self.names = [c[0] for c in connections]
+        self.published_pipe = wakeup_pipe()
+        self.daemons = [None] * len(connections)
+
+        # connect to all daemons at once; errors are reported by this thread
+        errors = [None] * len(connections)
+        def connect(i, name, section, *args):
+            deferred_quit.enabled = True
+            try:
+                self.daemons[i] = Transmission(*args, published_pipe=self.published_pipe, section=section)
+            except:
+                errors[i] = sys.exc_info()
+        threads = [threading.Thread(target=connect, args=(i,) + connection)
+                   for i, connection in enumerate(connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i, error in enumerate(errors):
+            if error and isinstance(error[1], DeferredQuit):
+                quit("%s: %s" % (self.names[i], error[1].msg), error[1].exitcode)
+            elif error:
+                raise error[0], error[1], error[2]
+        if None in self.daemons:
+            quit("Cannot connect to %s\n" % self.names[self.daemons.index(None)], CONNECTION_ERROR)
+
+        self.versions = [-1] * len(self.daemons)  # snapshot versions self.torrents was built from
+        self.torrents = [()] * len(self.daemons)  # each daemon's torrents with global ids
+        self.translated = [dict() for d in self.daemons]  # id() of a torrent -> (it, its translation)
+        self.merged   = ()        # all of them
+        self.index    = dict()
+        self.stats    = dict()
+        self.sorter   = TorrentSorter()
+        self.details_daemon = 0
+
+    def global_id(self, i, id):
+        return id * len(self.daemons) + i
+
+    def split_ids(self, ids):
+        """Return {daemon index: [ids on that daemon]}."""
+        ids_by_daemon = dict()
+        for id in ids:
+            ids_by_daemon.setdefault(id % len(self.daemons), []).append(id // len(self.daemons))
+        return ids_by_daemon
+
+    def route(self, method, ids, *args):
+        for i, daemon_ids in self.split_ids(ids).items():
+            getattr(self.daemons[i], method)(daemon_ids, *args)
+
+    def fileno(self):
+        return self.published_pipe[0]
+
+    def get_snapshot_version(self):
+        woken_up(self.published_pipe)
+        for daemon in self.daemons:
+            daemon.check_worker()
+        versions = [daemon.snapshot.version for daemon in self.daemons]
+        if versions != self.versions:
+            self.merge(versions)
+        return sum(versions)
+
+    def merge(self, versions):
+        """Translate the torrents of daemons with new snapshots and add up their stats."""
+        for i, daemon in enumerate(self.daemons):
+            if versions[i] != self.versions[i]:
+                # published torrents never change, so unchanged ones keep
+                # their translation and look unchanged to TorrentSorter etc.
+                translated = dict()
+                for t in daemon.snapshot.torrents:
+                    entry = self.translated[i].get(id(t))
+                    if entry is None:
+                        entry = (t, dict(t, id=self.global_id(i, t['id']), daemon=self.names[i]))
+                    translated[id(t)] = entry
+                self.translated[i] = translated
+                self.torrents[i] = tuple([translated[id(t)][1] for t in daemon.snapshot.torrents])
+        self.versions = versions
+        self.merged = tuple([t for torrents in self.torrents for t in torrents])
+        self.index = dict([(t['id'], t) for t in self.merged])
+
+        self.stats = dict(self.daemons[0].snapshot.stats)
+        for key in self.SUMMED_STATS:
+            self.stats[key] = sum([d.snapshot.stats.get(key, 0) for d in self.daemons])
+
+    def stop(self):
+        for daemon in self.daemons:
+            daemon.stop()
+
+    def notice_input(self):
+        for daemon in self.daemons:
+            daemon.notice_input()
+
+    def get_rpc_version(self):
+        return min([daemon.get_rpc_version() for daemon in self.daemons])
+
+    def get_address(self):
+        return ' '.join(self.names)
+
+    def get_connection_stats(self):
+        return [stats for daemon in self.daemons for stats in daemon.get_connection_stats()]
+
+    def get_global_stats(self):
+        return self.stats
+
+    def get_stale_since(self):
+        stale = [daemon.get_stale_since() for daemon in self.daemons if daemon.get_stale_since()]
+        return stale and min(stale) or None
+
+    def get_connection_error(self):
+        errors = ["%s: %s" % (self.names[i], daemon.get_connection_error())
+                  for i, daemon in enumerate(self.daemons) if daemon.get_connection_error()]
+        return ', '.join(errors) or None
+
+    def get_command_errors(self):
+        return [error for daemon in self.daemons for error in daemon.get_command_errors()]
+
+    def get_torrent_list(self, sort_orders):
+        return self.sorter.sort(self.merged, sort_orders)
+
+    def set_list_view(self, names):
+        for daemon in self.daemons:
+            daemon.set_list_view(names)
+
+    def get_torrents_by_ids(self, ids):
+        return [self.index[id] for id in ids if self.index.has_key(id)]
+
+    def get_torrent_by_id(self, id):
+        return self.index.get(id)
+
+    def get_torrent_details(self):
+        details = self.daemons[self.details_daemon].get_torrent_details()
+        if details:
+            details = dict(details, id=self.global_id(self.details_daemon, details['id']),
+                           daemon=self.names[self.details_daemon])
+        return details
+
+    def set_torrent_details_id(self, id):
+        self.daemons[self.details_daemon].set_torrent_details_id(-1)
+        if id >= 0:
+            self.details_daemon = id % len(self.daemons)
+            self.daemons[self.details_daemon].set_torrent_details_id(id // len(self.daemons))
+
+    def set_details_view(self, view):
+        self.daemons[self.details_daemon].set_details_view(view)
+
+    def get_hosts(self):
+        return self.daemons[self.details_daemon].get_hosts()
+
+    def get_geo_ips(self):
+        return self.daemons[self.details_daemon].get_geo_ips()
+
+    def set_option(self, option_name, option_value):
+        for daemon in self.daemons:
+            daemon.set_option(option_name, option_value)
+
+    def set_rate_limit(self, direction, new_limit, torrent_ids=[]):
+        if torrent_ids:
+            for i, ids in self.split_ids(torrent_ids).items():
+                self.daemons[i].set_rate_limit(direction, new_limit, ids)
+        else:
+            for daemon in self.daemons:
+                daemon.set_rate_limit(direction, new_limit)
+
+    def set_seed_ratio(self, ratio, torrent_ids):
+        for i, ids in self.split_ids(torrent_ids).items():
+            self.daemons[i].set_seed_ratio(ratio, ids)
+
+    def toggle_turtle_mode(self):
+        self.set_option('alt-speed-enabled', not self.stats['alt-speed-enabled'])
+
+    def add_torrent(self, location):
+        # there's no telling where it belongs, so the first daemon gets it
+        self.daemons[0].add_torrent(location)
+
+    def increase_bandwidth_priority(self, ids): self.route('increase_bandwidth_priority', ids)
+    def decrease_bandwidth_priority(self, ids): self.route('decrease_bandwidth_priority', ids)
+    def stop_torrents(self, ids):               self.route('stop_torrents', ids)
+    def start_torrents(self, ids):              self.route('start_torrents', ids)
+    def verify_torrents(self, ids):             self.route('verify_torrents', ids)
+    def reannounce_torrents(self, ids):         self.route('reannounce_torrents', ids)
+    def remove_torrents(self, ids):             self.route('remove_torrents', ids)
+    def remove_torrents_local_data(self, ids):  self.route('remove_torrents_local_data', ids)
+
+    def move_torrents(self, ids, new_location):
+        self.route('move_torrents', ids, new_location)
+
+    def add_torrent_tracker(self, id, tracker):
+        self.daemons[id % len(self.daemons)].add_torrent_tracker(id // len(self.daemons), tracker)
+
+    def remove_torrent_tracker(self, id, tracker):
+        self.daemons[id % len(self.daemons)].remove_torrent_tracker(id // len(self.daemons), tracker)
+
+    def increase_file_priority(self, file_nums):
+        self.daemons[self.details_daemon].increase_file_priority(file_nums)
+
+    def decrease_file_priority(self, file_nums):
+        self.daemons[self.details_daemon].decrease_file_priority(file_nums)
+
+    def get_file_priority(self, torrent_id, file_num):
+        return self.daemons[self.details_daemon].get_file_priority(torrent_id, file_num)
+
+    def get_status(self, torrent):
+        return self.daemons[0].get_status(torrent)
+
+    def get_bandwidth_priority(self, torrent):
+        return self.daemons[0].get_bandwidth_priority(torrent)
+
+# End of Class MultiTransmission
+
+
+# Polls a daemon on behalf of RPCProxy.  Torrents are kept as the daemon
+# sent them since they are passed on to other clients.
+class ProxyTransmission(Transmission):
+    LIST_FIELDS = Transmission.LIST_FIELDS + ['hashString', 'totalSize', 'percentDone',
+                                              'leftUntilDone', 'isFinished']
+
+    def __init__(self, *args):
+        # status_cache mixes both, clients must get what the daemon answers to each
+        self.session_arguments = dict()  # last answer to session-get
+        self.stats_arguments   = dict()  # last answer to session-stats
+        Transmission.__init__(self, *args)
+
+    def parse_response(self, response):
+        tag = Transmission.parse_response(self, response)
+        if tag == self.TAG_SESSION_GET:
+            self.session_arguments = response['arguments']
+        elif tag == self.TAG_SESSION_STATS:
+            self.stats_arguments = response['arguments']
+        return tag
+
+    def upgrade_torrent(self, t):
+        pass
+
+    def refresh_after_command(self):
+        # a client that polls right after its command must see the change
+        self.last_command_done = time.time()
+        names = [name for name, request in self.requests.items() if request.request_data]
+        for name in names:
+            self.requests[name].cancel()
+        self.fetch(*names)
+        for name in names:
+            self.requests[name].last_update = time.time()
+
+    def keep_awake(self):
+        """Poll at full speed while clients are asking."""
+        if self.idle_timeout and time.time() - self.last_input >= self.idle_timeout:
+            self.notice_input()
+        else:
+            self.last_input = time.time()
+
+
+# Answers the read requests of any number of clients from what one
+# ProxyTransmission has polled; everything else goes to the daemon.
+class RPCProxy:
+    READ_METHODS = ['torrent-get', 'session-get', 'session-stats']
+    # seconds that a changed or removed torrent is reported to 'recently-active' polls
+    RECENTLY_ACTIVE = 60
+
+    def __init__(self, server):
+        self.server  = server
+        self.lock    = threading.Lock()  # clients are served by several threads
+        self.version = -1
+        self.index   = dict()  # torrents of snapshot <version>
+        self.changed_at = dict()  # id -> time a torrent was seen changing
+        self.removed_at = dict()  # id -> time a torrent was seen disappearing
+
+    def answer(self, request):
+        method    = request.get('method')
+        arguments = request.get('arguments') or dict()
+        self.server.check_worker()
+        self.server.keep_awake()
+
+        result = None
+        if method in self.READ_METHODS and not self.server.get_connection_error():
+            self.lock.acquire()
+            try:
+                self.update()
+                result = getattr(self, 'answer_' + method.replace('-', '_'))(arguments)
+            finally:
+                self.lock.release()
+        if result is None:
+            answer = self.server.pass_through(method, arguments, request.get('tag'),
+                                              method not in self.READ_METHODS)
+        else:
+            answer = {'result': 'success', 'arguments': result}
+        if request.has_key('tag'):
+            answer['tag'] = request['tag']
+        return answer
+
+    def update(self):
+        """Find out which torrents changed since the last snapshot."""
+        snapshot = self.server.snapshot
+        if snapshot.version == self.version:
+            return
+        now = time.time()
+        for id, t in snapshot.index.items():
+            old = self.index.get(id)
+            if old is not t and old != t:
+                self.changed_at[id] = now
+        for id in self.index:
+            if not snapshot.index.has_key(id):
+                self.removed_at[id] = now
+                self.changed_at.pop(id, None)
+        for times in (self.changed_at, self.removed_at):
+            for id, when in times.items():
+                if now - when > self.RECENTLY_ACTIVE:
+                    del times[id]
+        self.index   = snapshot.index
+        self.version = snapshot.version
+
+    def answer_torrent_get(self, arguments):
+        fields = arguments.get('fields', [])
+        if not fields or not set(fields).issubset(self.server.list_fields):
+            return None
+        ids = arguments.get('ids')
+        removed = None
+        if ids is None:
+            torrents = self.index.values()
+        elif ids == 'recently-active':
+            torrents = [self.index[id] for id in self.changed_at]
+            removed  = self.removed_at.keys()
+        elif isinstance(ids, (int, long)):
+            torrents = [self.index[id] for id in [ids] if self.index.has_key(id)]
+        elif isinstance(ids, list) and not [id for id in ids if not isinstance(id, (int, long))]:
+            torrents = [self.index[id] for id in ids if self.index.has_key(id)]
+        else:
+            return None  # hash strings
+
+        if arguments.get('format') == 'table':
+            result = {'torrents': [fields] + [[t.get(f) for f in fields] for t in torrents]}
+        else:
+            result = {'torrents': [dict([(f, t[f]) for f in fields if t.has_key(f)]) for t in torrents]}
+        if removed is not None:
+            result['removed'] = removed
+        return result
+
+    def answer_session_get(self, arguments):
+        session = self.server.session_arguments
+        if arguments.get('fields'):
+            return dict([(key, session[key]) for key in arguments['fields'] if session.has_key(key)])
+        return dict(session)
+
+    def answer_session_stats(self, arguments):
+        return dict(self.server.stats_arguments)
+
+class RPCProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        try:
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        except ValueError:
+            self.close_connection = 1
+            return self.reply(400, 'Cannot parse request')
+
+        # refuse requests the way the daemon does
+        if not self.server.allows(self.client_address[0]):
+            return self.reply(403, 'Unauthorized IP Address.')
+        if not self.server.authenticates(self.headers.get('Authorization', '')):
+            return self.reply(401, 'Unauthorized User', {'WWW-Authenticate': 'Basic realm="Transmission"'})
+        if self.headers.get('X-Transmission-Session-Id') != self.server.session_id:
+            # keeps web pages from sending requests through the browser
+            return self.reply(409, '<h1>409: Conflict</h1><p><code>X-Transmission-Session-Id: %s</code></p>'
+                                   % self.server.session_id,
+                              {'X-Transmission-Session-Id': self.server.session_id})
+
+        try:
+            request = json_decode(data)
+        except ValueError:
+            return self.reply(400, 'Cannot parse request')
+        self.reply(200, json.dumps(self.server.proxy.answer(request)))
+
+    def reply(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', ('text/plain', 'application/json')[status == 200])
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if len(body) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        debug("proxy: %s %s\n" % (self.client_address[0], format % args))
+
+class RPCProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, whitelist, username, password):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RPCProxyHandler)
+        self.session_id  = os.urandom(24).encode('hex')
+        self.whitelist   = [pattern.strip() for pattern in whitelist.split(',') if pattern.strip()]
+        self.credentials = None
+        if username:
+            self.credentials = 'Basic ' + base64.b64encode('%s:%s' % (username, password))
+
+    def allows(self, address):
+        return bool([pattern for pattern in self.whitelist if fnmatch.fnmatch(address, pattern)])
+
+    def authenticates(self, authorization):
+        if not self.credentials:
+            return True
+        return hmac.compare_digest(authorization.strip(), self.credentials)
+
+
 
 
 
 # User Interface
 class Interface:
     TRACKER_ITEM_HEIGHT = 6
+    DETAILS_CATEGORIES = ['overview', 'files', 'peers', 'trackers', 'pieces']
 
     def __init__(self, server):
         self.server = server
@@ -740,12 +2657,18 @@ class Interface:
         self.torrentname_is_progressbar = config.getboolean('Misc', 'torrentname_is_progressbar')
 
         self.torrents         = self.server.get_torrent_list(self.sort_orders)
+        self.torrent_filter   = TorrentFilter()
+        self.torrent_search   = TorrentSearch()
         self.stats            = self.server.get_global_stats()
+        self.snapshot_version = -1  # version of the server's data that is on screen
         self.torrent_details  = []
         self.selected_torrent = -1  # changes to >-1 when focus >-1 & user hits return
+        self.details_id       = -1  # id of the torrent whose details are shown
         self.all_paused       = False
         self.highlight_dialog = False
         self.search_focus = 0   # like self.focus but for searches in torrent list
+        self.marked_ids   = set() # ids of torrents that actions apply to instead of the focused one
+        self.mark_anchor_id = -1  # last (un)marked torrent, start of range marking
         self.focused_id   = -1  # the id (provided by Transmission) of self.torrents[self.focus]
         self.focus        = -1  # -1: nothing focused; 0: top of list; <# of torrents>-1: bottom of list
         self.scrollpos    = 0   # start of torrentlist
@@ -814,7 +2737,10 @@ class Interface:
             ord('a'):               self.a_key,
             ord('m'):               self.move_torrent,
             ord('n'):               self.reannounce_torrent,
-            ord('/'):               self.dialog_search_torrentlist
+            ord('/'):               self.dialog_search_torrentlist,
+            ord('x'):               self.mark_torrent,
+            ord('X'):               self.mark_torrent_range,
+            ord('A'):               self.mark_all_torrents
         }
 
         self.sort_options = [
@@ -842,7 +2768,7 @@ class Interface:
         os.environ['ESCDELAY'] = '0' # make escape usable
         self.screen = curses.initscr()
         curses.noecho() ; curses.cbreak() ; self.screen.keypad(1)
-        curses.halfdelay(10) # STDIN timeout
+        self.screen.nodelay(1) # waiting for input is done by run()
 
         hide_cursor()
 
@@ -891,13 +2817,15 @@ class Interface:
             else:
                 break
         self.manage_layout()
+        self.snapshot_version = -1  # redraw everything
 
     def manage_layout(self):
         self.tlist_item_height = 3 if not self.compact_list else 1
-        self.pad_height = max((len(self.torrents)+1) * self.tlist_item_height, self.height)
-        self.pad = curses.newpad(self.pad_height, self.width)
         self.mainview_height = self.height - 2
         self.torrents_per_page = self.mainview_height / self.tlist_item_height
+        # the pad only holds the torrents on screen
+        self.pad_height = max((self.torrents_per_page+2) * self.tlist_item_height, self.height)
+        self.pad = curses.newpad(self.pad_height, self.width)
         self.detaillistitems_per_page = self.height - 8
 
         if self.selected_torrent > -1:
@@ -936,26 +2864,15 @@ class Interface:
 
 
     def run(self):
-        self.draw_title_bar()
-        self.draw_stats()
-        self.draw_torrent_list()
-
         while True:
-            self.server.update(1)
-
-            # display torrentlist
-            if self.selected_torrent == -1:
-                self.draw_torrent_list()
-
-            # display some torrent's details
-            else:
-                self.draw_details()
-
-            self.stats = self.server.get_global_stats()
-            self.draw_title_bar()  # show shortcuts and stuff
-            self.draw_stats()      # show global states
-            self.screen.move(0,0)  # in case cursor can't be invisible
-            self.handle_user_input()
+            # the polling thread publishes a new version whenever something changed
+            snapshot_version = self.server.get_snapshot_version()
+            if snapshot_version != self.snapshot_version:
+                self.snapshot_version = snapshot_version
+                self.redraw()
+            self.show_command_errors()
+            if not self.handle_user_input():
+                self.wait_for_input()
             if self.exit_now:
                 sort_str = ','.join(map(lambda x: ('','reverse:')[x['reverse']] + x['name'], self.sort_orders))
                 config.set('Sorting', 'order',   sort_str)
@@ -964,8 +2881,38 @@ class Interface:
                 config.set('Misc', 'compact_list', str(self.compact_list))
                 config.set('Misc', 'torrentname_is_progressbar', str(self.torrentname_is_progressbar))
                 save_config(cmd_args.configfile)
+                self.server.stop()
                 return
 
+    def wait_for_input(self):
+        """Sleep until a key is pressed or the server has new data."""
+        try:
+            select.select([sys.stdin, self.server], [], [])
+        except select.error:
+            pass  # interrupted by SIGWINCH
+
+    def redraw(self):
+        self.stats = self.server.get_global_stats()
+
+        # display torrentlist
+        if self.selected_torrent == -1:
+            self.draw_torrent_list()
+
+        # display some torrent's details
+        else:
+            self.draw_details()
+
+        self.draw_title_bar()  # show shortcuts and stuff
+        self.draw_stats()      # show global states
+        self.screen.move(0,0)  # in case cursor can't be invisible
+
+    def show_command_errors(self):
+        for error in self.server.get_command_errors():
+            msg = []
+            for line in error.split("\n"):
+                msg.extend(wrap(line, self.width-8))
+            self.dialog_ok("\n".join(msg))
+
     def go_back_or_unfocus(self, c):
         if self.focus_detaillist > -1:   # unfocus and deselect file
             self.focus_detaillist     = -1
@@ -976,7 +2923,9 @@ class Interface:
             self.selected_torrent = -1
             self.selected_files   = []
         else:
-            if self.focus > -1:
+            if self.marked_ids:
+                self.marked_ids = set() # unmark all torrents
+            elif self.focus > -1:
                 self.scrollpos = 0    # unfocus main list
                 self.focus     = -1
             elif self.filter_list:
@@ -1064,18 +3013,15 @@ class Interface:
     def add_torrent(self):
         location = self.dialog_input_text("Add torrent from file or URL", os.getcwd())
         if location:
-            error = self.server.add_torrent(location)
-            if error:
-                msg = wrap("Couldn't add torrent \"%s\":" % location)
-                msg.extend(wrap(error, self.width-4))
-                self.dialog_ok("\n".join(msg))
+            self.server.add_torrent(location)
 
     def select_torrent_detail_view(self, c):
         if self.focus > -1 and self.selected_torrent == -1:
             self.screen.clear()
             self.selected_torrent = self.focus
-            self.server.set_torrent_details_id(self.torrents[self.focus]['id'])
-            self.server.wait_for_details_update()
+            self.details_id = self.torrents[self.focus]['id']
+            self.update_details_fields()
+            self.server.set_torrent_details_id(self.details_id)
 
     def show_sort_order_menu(self, c):
         if self.selected_torrent == -1:
@@ -1094,12 +3040,18 @@ class Interface:
             options = [('uploading','_Uploading'), ('downloading','_Downloading'),
                        ('active','Ac_tive'), ('paused','_Paused'), ('seeding','_Seeding'),
                        ('incomplete','In_complete'), ('verifying','Verif_ying'),
-                       ('invert','In_vert'), ('','_All')]
-            choice = self.dialog_menu(('Show only','Filter all')[self.filter_inverse], options,
-                                      map(lambda x: x[0]==self.filter_list, options).index(True)+1)
+                       ('query','Qu_ery...'), ('invert','In_vert'), ('','_All')]
+            names = [x[0] for x in options]
+            if self.filter_list in names:
+                focus = names.index(self.filter_list) + 1
+            else:
+                focus = names.index('query') + 1
+            choice = self.dialog_menu(('Show only','Filter all')[self.filter_inverse], options, focus)
             if choice != -128:
                 if choice == 'invert':
                     self.filter_inverse = not self.filter_inverse
+                elif choice == 'query':
+                    self.dialog_filter_query()
                 else:
                     if choice == '':
                         self.filter_inverse = False
@@ -1120,95 +3072,157 @@ class Interface:
        self.server.set_rate_limit('down', limit)
 
     def torrent_upload(self, c):
-        if self.focus > -1:
-            current_limit = (-1,self.torrents[self.focus]['uploadLimit'])[self.torrents[self.focus]['uploadLimited']]
+        torrents = self.get_action_torrents()
+        if torrents:
+            current_limit = (-1,torrents[0]['uploadLimit'])[torrents[0]['uploadLimited']]
             limit = self.dialog_input_number("Upload limit in kilobytes per second for\n%s" % \
-                                                 self.torrents[self.focus]['name'], current_limit)
+                                                 self.describe_torrents(torrents), current_limit)
             if limit == -128:
                 return 
-            self.server.set_rate_limit('up', limit, self.torrents[self.focus]['id'])
+            self.server.set_rate_limit('up', limit, [t['id'] for t in torrents])
 
     def torrent_download(self, c):
-        if self.focus > -1:
-            current_limit = (-1,self.torrents[self.focus]['downloadLimit'])[self.torrents[self.focus]['downloadLimited']]
+        torrents = self.get_action_torrents()
+        if torrents:
+            current_limit = (-1,torrents[0]['downloadLimit'])[torrents[0]['downloadLimited']]
             limit = self.dialog_input_number("Download limit in Kilobytes per second for\n%s" % \
-                                                 self.torrents[self.focus]['name'], current_limit)
+                                                 self.describe_torrents(torrents), current_limit)
             if limit == -128:
                 return 
-            self.server.set_rate_limit('down', limit, self.torrents[self.focus]['id'])
+            self.server.set_rate_limit('down', limit, [t['id'] for t in torrents])
 
     def seed_ratio(self, c):
-        if self.focus > -1:
-            if self.torrents[self.focus]['seedRatioMode'] == 0:   # Use global settings
+        torrents = self.get_action_torrents()
+        if torrents:
+            if torrents[0]['seedRatioMode'] == 0:   # Use global settings
                 current_limit = ''
-            elif self.torrents[self.focus]['seedRatioMode'] == 1: # Stop seeding at seedRatioLimit
-                current_limit = self.torrents[self.focus]['seedRatioLimit']
-            elif self.torrents[self.focus]['seedRatioMode'] == 2: # Seed regardless of ratio
+            elif torrents[0]['seedRatioMode'] == 1: # Stop seeding at seedRatioLimit
+                current_limit = torrents[0]['seedRatioLimit']
+            elif torrents[0]['seedRatioMode'] == 2: # Seed regardless of ratio
                 current_limit = -1
-            limit = self.dialog_input_number("Seed ratio limit for\n%s" % self.torrents[self.focus]['name'],
+            limit = self.dialog_input_number("Seed ratio limit for\n%s" % self.describe_torrents(torrents),
                                              current_limit, floating_point=True, allow_empty=True)
             if limit == -1:
                 limit = 0
             if limit == -2: # -2 means 'empty' in dialog_input_number return codes
                 limit = -1
-            self.server.set_seed_ratio(float(limit), self.torrents[self.focus]['id'])
+            self.server.set_seed_ratio(float(limit), [t['id'] for t in torrents])
 
     def bandwidth_priority(self, c):
-        if c == ord('-') and self.focus > -1:
-            self.server.decrease_bandwidth_priority(self.torrents[self.focus]['id'])
-        elif c == ord('+') and self.focus > -1:
-            self.server.increase_bandwidth_priority(self.torrents[self.focus]['id'])
+        ids = [t['id'] for t in self.get_action_torrents()]
+        if c == ord('-') and ids:
+            self.server.decrease_bandwidth_priority(ids)
+        elif c == ord('+') and ids:
+            self.server.increase_bandwidth_priority(ids)
 
     def pause_unpause_torrent(self, c):
-        if self.focus > -1:
-            if self.selected_torrent > -1:
-                t = self.torrent_details
+        torrents = self.get_action_torrents()
+        if torrents:
+            running = [t['id'] for t in torrents if t['status'] != Transmission.STATUS_STOPPED]
+            if running:
+                self.server.stop_torrents(running)
             else:
-                t = self.torrents[self.focus]
-            if t['status'] == Transmission.STATUS_STOPPED:
-                self.server.start_torrent(t['id'])
-            else:
-                self.server.stop_torrent(t['id'])
+                self.server.start_torrents([t['id'] for t in torrents])
 
     def pause_unpause_all_torrent(self, c):
+        ids = [t['id'] for t in self.torrents]
+        if not ids:
+            return
         if self.all_paused:
-            for t in self.torrents:
-                self.server.start_torrent(t['id'])
+            self.server.start_torrents(ids)
             self.all_paused = False
         else:
-            for t in self.torrents:
-                self.server.stop_torrent(t['id'])
+            self.server.stop_torrents(ids)
             self.all_paused = True
 
     def verify_torrent(self, c):
-        if self.focus > -1:
-            if self.torrents[self.focus]['status'] != Transmission.STATUS_CHECK \
-           and self.torrents[self.focus]['status'] != Transmission.STATUS_CHECK_WAIT:
-                self.server.verify_torrent(self.torrents[self.focus]['id'])
+        ids = [t['id'] for t in self.get_action_torrents()
+               if t['status'] != Transmission.STATUS_CHECK and t['status'] != Transmission.STATUS_CHECK_WAIT]
+        if ids:
+            self.server.verify_torrents(ids)
 
     def reannounce_torrent(self, c):
-        if self.focus > -1:
-            self.server.reannounce_torrent(self.torrents[self.focus]['id'])
+        ids = [t['id'] for t in self.get_action_torrents()]
+        if ids:
+            self.server.reannounce_torrents(ids)
 
     def remove_torrent(self, c):
-        if self.focus > -1:
-            name = self.torrents[self.focus]['name'][0:self.width - 15]
+        torrents = self.get_action_torrents()
+        if torrents:
+            name = self.describe_torrents(torrents)[0:self.width - 15]
             if self.dialog_yesno("Remove %s?" % name) == True:
-                if self.selected_torrent > -1:  # leave details
-                    self.server.set_torrent_details_id(-1)
-                    self.selected_torrent = -1
-                    self.details_category_focus = 0
-                self.server.remove_torrent(self.torrents[self.focus]['id'])
+                self.remove_torrents(torrents, self.server.remove_torrents)
 
     def remove_torrent_local_data(self, c):
-        if self.focus > -1:
-            name = self.torrents[self.focus]['name'][0:self.width - 15]
+        torrents = self.get_action_torrents()
+        if torrents:
+            name = self.describe_torrents(torrents)[0:self.width - 15]
             if self.dialog_yesno("Remove and delete %s?" % name, important=True) == True:
-                if self.selected_torrent > -1:  # leave details
-                    self.server.set_torrent_details_id(-1)
-                    self.selected_torrent = -1
-                    self.details_category_focus = 0
-                self.server.remove_torrent_local_data(self.torrents[self.focus]['id'])
+                self.remove_torrents(torrents, self.server.remove_torrents_local_data)
+
+    def remove_torrents(self, torrents, remove):
+        if self.selected_torrent > -1:  # leave details
+            self.server.set_torrent_details_id(-1)
+            self.selected_torrent = -1
+            self.details_category_focus = 0
+        ids = [t['id'] for t in torrents]
+        self.marked_ids.difference_update(ids)
+        remove(ids)
+
+    def get_action_torrents(self):
+        """Torrents that the next action applies to: the marked ones or the focused one."""
+        if self.selected_torrent > -1:
+            return [self.torrent_details]
+        marked = self.get_marked_torrents()
+        if marked:
+            return marked
+        elif self.focus > -1:
+            return [self.torrents[self.focus]]
+        return []
+
+    def get_marked_torrents(self):
+        torrents = self.server.get_torrents_by_ids(self.marked_ids)
+        if len(torrents) < len(self.marked_ids):  # some marked torrents are gone
+            self.marked_ids = set([t['id'] for t in torrents])
+        return torrents
+
+    def describe_torrents(self, torrents):
+        if len(torrents) == 1:
+            return torrents[0]['name']
+        return "%d marked torrents" % len(torrents)
+
+    def mark_torrent(self, c):
+        if self.selected_torrent == -1 and self.focus > -1:
+            id = self.torrents[self.focus]['id']
+            if id in self.marked_ids:
+                self.marked_ids.remove(id)
+            else:
+                self.marked_ids.add(id)
+            self.mark_anchor_id = id
+            curses.ungetch(curses.KEY_DOWN) # move down
+
+    def mark_torrent_range(self, c):
+        if self.selected_torrent == -1 and self.focus > -1:
+            anchor = self.torrents.position(self.mark_anchor_id)
+            if anchor == -1:
+                anchor = self.focus
+            self.marked_ids.update([t['id'] for t in self.torrents[min(anchor, self.focus):max(anchor, self.focus)+1]])
+            self.mark_anchor_id = self.torrents[self.focus]['id']
+
+    def mark_all_torrents(self, c):
+        if self.selected_torrent == -1:
+            self.mark_torrents(self.torrents)
+
+    def mark_search_matches(self, search_keyword):
+        self.mark_torrents(self.torrent_search.search(self.torrents, search_keyword))
+        self.draw_torrent_list(search_keyword)
+
+    def mark_torrents(self, torrents):
+        ids = set([t['id'] for t in torrents])
+        if ids and ids.issubset(self.marked_ids):  # all marked already, so unmark them
+            self.marked_ids.difference_update(ids)
+        else:
+            self.marked_ids.update(ids)
 
     def add_tracker(self):
         if self.server.get_rpc_version() < 10:
@@ -1218,11 +3232,7 @@ class Interface:
         tracker = self.dialog_input_text('Add tracker URL:')
         if tracker:
             t = self.torrent_details
-            response = self.server.add_torrent_tracker(t['id'], tracker)
-
-            if response:
-                msg = wrap("Couldn't add tracker: %s" % response)
-                self.dialog_ok("\n".join(msg))
+            self.server.add_torrent_tracker(t['id'], tracker)
 
     def remove_tracker(self):
         if self.server.get_rpc_version() < 10:
@@ -1235,11 +3245,7 @@ class Interface:
             self.dialog_yesno("Do you want to remove this tracker?") is True):
 
             tracker = t['trackerStats'][self.scrollpos_detaillist]
-            response = self.server.remove_torrent_tracker(t['id'], tracker['id'])
-
-            if response:
-                msg = wrap("Couldn't remove tracker: %s" % response)
-                self.dialog_ok("\n".join(msg))
+            self.server.remove_torrent_tracker(t['id'], tracker['id'])
 
     def movement_keys(self, c):
         if self.selected_torrent == -1 and len(self.torrents) > 0:
@@ -1386,69 +3392,41 @@ class Interface:
         self.compact_list = not self.compact_list
 
     def move_torrent(self, c):
-        if self.focus > -1:
-            location = homedir2tilde(self.torrents[self.focus]['downloadDir'])
-            msg = 'Move "%s" from\n%s to' % (self.torrents[self.focus]['name'], location)
+        torrents = self.get_action_torrents()
+        if torrents:
+            location = homedir2tilde(torrents[0]['downloadDir'])
+            msg = 'Move "%s" from\n%s to' % (self.describe_torrents(torrents), location)
             path = self.dialog_input_text(msg, location)
             if path:
-                self.server.move_torrent(self.torrents[self.focus]['id'], tilde2homedir(path))
+                self.server.move_torrents([t['id'] for t in torrents], tilde2homedir(path))
 
     def handle_user_input(self):
         c = self.screen.getch()
         if c == -1:
-            return 0
+            return False
+        self.server.notice_input()
 
         f = self.keybindings.get(c, None)
         if f:
             f(c)
 
         # update view
-        if self.selected_torrent == -1:
-            self.draw_torrent_list()
-        else:
-            self.draw_details()
+        self.redraw()
+        return True
 
     def filter_torrent_list(self):
-        unfiltered = self.torrents
-        if self.filter_list == 'downloading':
-            self.torrents = [t for t in self.torrents if t['rateDownload'] > 0]
-        elif self.filter_list == 'uploading':
-            self.torrents = [t for t in self.torrents if t['rateUpload'] > 0]
-        elif self.filter_list == 'paused':
-            self.torrents = [t for t in self.torrents if t['status'] == Transmission.STATUS_STOPPED]
-        elif self.filter_list == 'seeding':
-            self.torrents = [t for t in self.torrents if t['status'] == Transmission.STATUS_SEED \
-                                 or t['status'] == Transmission.STATUS_SEED_WAIT]
-        elif self.filter_list == 'incomplete':
-            self.torrents = [t for t in self.torrents if t['percentDone'] < 100]
-        elif self.filter_list == 'active':
-            self.torrents = [t for t in self.torrents if t['peersGettingFromUs'] > 0 \
-                                 or t['peersSendingToUs'] > 0 \
-                                 or t['status'] == Transmission.STATUS_CHECK]
-        elif self.filter_list == 'verifying':
-            self.torrents = [t for t in self.torrents if t['status'] == Transmission.STATUS_CHECK \
-                                 or t['status'] == Transmission.STATUS_CHECK_WAIT]
-        # invert list?
-        if self.filter_inverse:
-            self.torrents = [t for t in unfiltered if t not in self.torrents]
+        self.torrents = self.torrent_filter.filter(self.torrents, self.filter_list, self.filter_inverse)
 
     def follow_list_focus(self):
         if self.focus == -1:
             return
 
-        # check if list is empty or id to look for isn't in list
-        ids = [t['id'] for t in self.torrents]
-        if len(self.torrents) == 0 or self.focused_id not in ids:
-            self.focus, self.scrollpos = -1, 0
-            return
-
-        # find focused_id
-        self.focus = min(self.focus, len(self.torrents)-1)
-        if self.torrents[self.focus]['id'] != self.focused_id:
-            for i,t in enumerate(self.torrents):
-                if t['id'] == self.focused_id:
-                    self.focus = i
-                    break
+        # find focused_id; it may have been removed or filtered out
+        if self.focus >= len(self.torrents) or self.torrents[self.focus]['id'] != self.focused_id:
+            self.focus = self.torrents.position(self.focused_id)
+            if self.focus == -1:
+                self.scrollpos = 0
+                return
 
         # make sure the focus is not above the visible area
         while self.focus < (self.scrollpos/self.tlist_item_height):
@@ -1461,11 +3439,12 @@ class Interface:
         self.scrollpos = max(0, self.scrollpos)
 
     def draw_torrent_list(self, search_keyword=''):
+        self.update_list_fields()
         self.torrents = self.server.get_torrent_list(self.sort_orders)
         self.filter_torrent_list()
 
         if search_keyword:
-            matched_torrents = [t for t in self.torrents if search_keyword.lower() in t['name'].lower()]
+            matched_torrents = self.torrent_search.search(self.torrents, search_keyword)
             if matched_torrents:
                 self.focus = 0
                 if self.search_focus >= len(matched_torrents):
@@ -1482,16 +3461,25 @@ class Interface:
         self.manage_layout()
 
         ypos = 0
-        for i in range(len(self.torrents)):
+        first = self.scrollpos / self.tlist_item_height
+        for i in range(first, min(len(self.torrents), first + self.torrents_per_page + 1)):
             ypos += self.draw_torrentlist_item(self.torrents[i],
                                                (i == self.focus),
                                                self.compact_list,
                                                ypos)
 
-        self.pad.refresh(self.scrollpos,0, 1,0, self.mainview_height,self.width-1)
+        self.pad.refresh(0,0, 1,0, self.mainview_height,self.width-1)
         self.screen.refresh()
 
 
+    def update_list_fields(self):
+        view = [sort_order['name'] for sort_order in self.sort_orders]
+        if self.filter_list:
+            view.extend(compile_filter_query(self.filter_list).fields)
+        if not self.compact_list:
+            view.append('status_line')
+        self.server.set_list_view(view)
+
     def draw_torrentlist_item(self, torrent, focused, compact, y):
         # the torrent name is also a progress bar
         self.draw_torrentlist_title(torrent, focused, self.torrent_title_width, y)
@@ -1553,7 +3541,12 @@ class Interface:
                 size = "%6s / " % scale_bytes(torrent['available']) + size
             size = "%6s / " % scale_bytes(torrent['haveValid'] + torrent['haveUnchecked']) + size
         size = '| ' + size
-        title = ljust_columns(torrent['name'], width - len(size)) + size
+        name = torrent['name']
+        if torrent.has_key('daemon'):
+            name = "[%s] %s" % (torrent['daemon'], name)
+        if torrent['id'] in self.marked_ids:
+            name = '* ' + name
+        title = ljust_columns(name, width - len(size)) + size
 
         if torrent['status'] == Transmission.STATUS_SEED \
         or torrent['status'] == Transmission.STATUS_SEED_WAIT:
@@ -1631,8 +3624,34 @@ class Interface:
         self.pad.addstr(ypos+1, 0, line, tags)
 
 
+    def update_details_fields(self):
+        self.server.set_details_view(self.DETAILS_CATEGORIES[self.details_category_focus])
+
     def draw_details(self):
-        self.torrent_details = self.server.get_torrent_details()
+        self.update_details_fields()
+        details = self.server.get_torrent_details()
+        view = self.DETAILS_CATEGORIES[self.details_category_focus]
+        needed = Transmission.DETAIL_FIELDS_STATIC + Transmission.DETAIL_FIELDS_FOR[view] + ['files']
+        if details and details['id'] == self.details_id and \
+                not [field for field in needed if not details.has_key(field)]:
+            self.torrent_details = details
+        else:
+            # details haven't arrived yet or are still those of another torrent
+            torrent = self.server.get_torrent_by_id(self.details_id)
+            if not torrent:
+                self.leave_details(None)
+                self.draw_torrent_list()
+                return
+            self.torrent_details = dict(files=[], fileStats=[], wanted=[], priorities=[],
+                                        peers=[], trackerStats=[], pieceCount=0)
+            self.torrent_details.update(torrent)
+            self.manage_layout()
+            self.pad = curses.newpad(self.height, self.width)
+            self.draw_torrentlist_item(self.torrent_details, False, False, 0)
+            self.pad.addstr(5, 1, 'Waiting for details ...', curses.A_BOLD)
+            self.pad.refresh(0,0, 1,0, self.height-2,self.width)
+            self.screen.refresh()
+            return
         self.manage_layout()
 
         # details could need more space than the torrent list
@@ -1690,9 +3709,10 @@ class Interface:
         info.append(sizes)
 
         info.append(['Files: ', "%d;  " % len(t['files'])])
-        complete     = map(lambda x: x['bytesCompleted'] == x['length'], t['files']).count(True)
-        not_complete = filter(lambda x: x['bytesCompleted'] != x['length'], t['files'])
-        partial      = map(lambda x: x['bytesCompleted'] > 0, not_complete).count(True)
+        progress     = [(f['length'], s['bytesCompleted']) for f, s in zip(t['files'], t['fileStats'])]
+        complete     = map(lambda x: x[1] == x[0], progress).count(True)
+        not_complete = filter(lambda x: x[1] != x[0], progress)
+        partial      = map(lambda x: x[1] > 0, not_complete).count(True)
         if complete == len(t['files']):
             info[-1].append("all complete")
         else:
@@ -1851,6 +3871,7 @@ class Interface:
     def create_filelist(self):
         filelist = []
         files = self.torrent_details['files']
+        file_stats = self.torrent_details['fileStats']
         current_folder = []
         current_depth = 0
         index = 0
@@ -1862,7 +3883,7 @@ class Interface:
             if f[:f_len] != current_folder:
                 [current_depth, pos] = self.create_filelist_transition(f, current_folder, filelist, current_depth, pos)
                 current_folder = f[:f_len]
-            filelist.append(self.create_filelist_line(f[-1], index, percent(file['length'], file['bytesCompleted']),
+            filelist.append(self.create_filelist_line(f[-1], index, percent(file['length'], file_stats[index]['bytesCompleted']),
                 file['length'], current_depth))
             index += 1
             if self.focus_detaillist == index - 1:
@@ -2201,6 +4222,10 @@ class Interface:
             self.screen.addstr("Paused:", curses.A_REVERSE)
             self.screen.addstr("%d) " % paused, curses.A_REVERSE)
 
+            if self.marked_ids:
+                self.screen.addstr("Marked:", curses.A_REVERSE)
+                self.screen.addstr("%d " % len(self.get_marked_torrents()), curses.A_REVERSE)
+
             if self.filter_list:
                 self.screen.addstr("Filter:", curses.A_REVERSE)
                 self.screen.addstr("%s%s" % (('','not ')[self.filter_inverse], self.filter_list),
@@ -2261,9 +4286,19 @@ class Interface:
         self.draw_connection_status()
         self.draw_quick_help()
     def draw_connection_status(self):
-        status = "Transmission @ %s:%s" % (self.server.host, self.server.port)
+        status = "Transmission @ %s" % self.server.get_address()
         if cmd_args.DEBUG:
-            status = "%d x %d " % (self.width, self.height) + status
+            connections = self.server.get_connection_stats()
+            reuse = ' '.join(["%d/%d" % (c['requests'], c['reconnects']) for c in connections])
+            received = sum([c['received'] for c in connections])
+            decoded  = sum([c['decoded'] for c in connections])
+            status = "%d x %d [%s] %s/%s " % (self.width, self.height, reuse,
+                                              scale_bytes(received), scale_bytes(decoded)) + status
+        stale_since = self.server.get_stale_since()
+        if stale_since:
+            status += " (no answer since %s" % time.strftime('%H:%M:%S', time.localtime(stale_since))
+            error = self.server.get_connection_error()
+            status += ("", ": %s, reconnecting" % error)[bool(error)] + ")"
         self.screen.addstr(0, 0, status.encode('utf-8'), curses.A_REVERSE)
 
     def draw_quick_help(self):
@@ -2297,7 +4332,7 @@ class Interface:
                   "            U/D  Adjust maximum upload/download rate for focused torrent\n" + \
                   "              L  Set seed ratio limit for focused torrent\n" + \
                   "            +/-  Adjust bandwidth priority for focused torrent\n" + \
-                  "              p  Pause/Unpause torrent\n" + \
+                  "              p  Pause/Unpause torrent (or all marked torrents)\n" + \
                   "              P  Pause/Unpause all torrents\n" + \
                   "            v/y  Verify torrent\n" + \
                   "              m  Move torrent\n" + \
@@ -2307,14 +4342,17 @@ class Interface:
                   "    Shift+Del/R  Remove torrent and delete content\n"
         # Torrent list
         if self.selected_torrent == -1:
-            message += "              /  Search in torrent list\n" + \
+            message += "              /  Search in torrent list (Ctrl+t marks all matches)\n" + \
+                       "              x  Mark/Unmark torrent\n" + \
+                       "              X  Mark all torrents up to the last (un)marked one\n" + \
+                       "              A  Mark/Unmark all listed torrents\n" + \
                        "              f  Filter torrent list\n" + \
                        "              s  Sort torrent list\n" \
                        "    Enter/Right  View torrent's details\n" + \
                        "              o  Configuration options\n" + \
                        "              t  Toggle turtle mode\n" + \
                        "              C  Toggle compact list mode\n" + \
-                       "            Esc  Unfocus\n" + \
+                       "            Esc  Unmark all or unfocus\n" + \
                        "              q  Quit"
         else:
             # Peer list
@@ -2439,7 +4477,7 @@ class Interface:
             elif c == 27 or c == curses.KEY_BREAK:
                 return -1
 
-    def dialog_input_text(self, message, input='', on_change=None, on_enter=None):
+    def dialog_input_text(self, message, input='', on_change=None, on_enter=None, on_keys={}):
         width  = self.width - 4
         textwidth = self.width - 8
         height = message.count("\n") + 4
@@ -2481,6 +4519,8 @@ class Interface:
                 index = 0
             elif c == curses.KEY_END or c == curses.ascii.ctrl(ord('e')):
                 index = len(input)
+            elif on_keys.has_key(c):
+                on_keys[c](input)
             elif c == ord('\n'):
                 if on_enter:
                     on_enter(input)
@@ -2493,10 +4533,27 @@ class Interface:
                 if on_change: on_change(input)
             if on_change: win.redrawwin()
 
+    def dialog_filter_query(self):
+        query = self.filter_list
+        while True:
+            query = self.dialog_input_text("Show torrents that match, e.g.\n" +
+                                           "ratio<1 and tracker~foo and (size>10G or not seeding)", query)
+            if not query.strip():
+                return
+            try:
+                compile_filter_query(query)
+            except ValueError, msg:
+                self.dialog_ok(str(msg))
+                continue
+            self.filter_list = query
+            return
+
     def dialog_search_torrentlist(self, c):
+        self.torrent_search.update(self.torrents)  # before the first keystroke
         self.dialog_input_text('Search torrent by title:',
                                on_change=self.draw_torrent_list,
-                               on_enter=self.increment_search)
+                               on_enter=self.increment_search,
+                               on_keys={curses.ascii.ctrl(ord('t')): self.mark_search_matches})
 
     def increment_search(self, input):
         self.search_focus += 1
@@ -2635,6 +4692,7 @@ class Interface:
         enc_options = [('required','_required'), ('preferred','_preferred'), ('tolerated','_tolerated')]
         seed_ratio = self.stats['seedRatioLimit']
         while True:
+            self.stats = self.server.get_global_stats()
             options = []
             options.append(('Peer _Port', "%d" % self.stats['peer-port']))
             options.append(('UP_nP/NAT-PMP', ('disabled','enabled ')[self.stats['port-forwarding-enabled']]))
@@ -2918,6 +4976,25 @@ def num2str(num):
             return str(num)
 
 
+def wakeup_pipe():
+    """Pipe to wake up a thread sleeping in select(); neither end ever blocks."""
+    pipe = os.pipe()
+    for fd in pipe:
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return pipe
+
+def wake_up(pipe):
+    try:
+        os.write(pipe[1], '.')
+    except OSError:
+        pass  # pipe is full, reader will wake up anyway
+
+def woken_up(pipe):
+    try:
+        return bool(os.read(pipe[0], 4096))
+    except OSError:
+        return False
+
 def debug(data):
     if cmd_args.DEBUG:
         file = open("debug.log", 'a')
@@ -2929,7 +5006,17 @@ def debug(data):
             file.write("\n====================\n" + pp.pformat(data) + "\n====================\n\n")
         file.close
 
+# quit() raises DeferredQuit instead of exiting in threads that set
+# deferred_quit.enabled; they leave exiting to the main thread
+deferred_quit = threading.local()
+class DeferredQuit(Exception):
+    def __init__(self, msg, exitcode):
+        Exception.__init__(self, msg)
+        self.msg, self.exitcode = msg, exitcode
+
 def quit(msg='', exitcode=0):
+    if getattr(deferred_quit, 'enabled', False):
+        raise DeferredQuit(msg, exitcode)
     try:
         curses.endwin()
     except curses.error:
@@ -3025,6 +5112,40 @@ def create_config(option, opt_str, value, parser):
     print "Wrote config file: %s" % configfile
     exit(0)
 
+def benchmark_json(filepath, rounds=10):
+    """Time all available JSON decoders on a torrent-get answer stored in <filepath>."""
+    if not os.path.isfile(filepath):
+        # capture a complete torrent list from the daemon
+        pool = get_connection_pool(config.get('Connection', 'host'), config.getint('Connection', 'port'),
+                                   config.get('Connection', 'path'), config.get('Connection', 'username'),
+                                   config.get('Connection', 'password'))
+        request = TransmissionRequest(pool, config.get('Connection', 'path'), 'torrent-get',
+                                      Transmission.TAG_TORRENT_LIST, {'fields': Transmission.LIST_FIELDS})
+        request.send_request()
+        try:
+            open(filepath, 'w').write(json.dumps(request.get_response(), ensure_ascii=False).encode('utf-8'))
+        except IOError, msg:
+            quit("Cannot write %s: %s\n" % (filepath, msg), 1)
+        print "Captured torrent list in %s" % filepath
+
+    payload = open(filepath).read()
+    print "Decoding %d bytes %d times:" % (len(payload), rounds)
+    for name, decode in json_decoders:
+        start = time.time()
+        for i in range(rounds):
+            decode(payload)
+        print "%12s  %7.1f ms%s" % (name, (time.time() - start) / rounds * 1000,
+                                    ('', '  (active)')[name == json_decoder_name])
+    # how torrent-get answers are actually decoded, see TorrentListDecoder
+    start = time.time()
+    for i in range(rounds):
+        decoder = TorrentListDecoder(lambda t: t)
+        for pos in range(0, len(payload), 65536):
+            decoder.feed(payload[pos:pos + 65536])
+        decoder.close()
+    print "%12s  %7.1f ms  (torrent list)" % ('stream', (time.time() - start) / rounds * 1000)
+    exit(0)
+
 def save_config(filepath, force=False):
     if force or os.path.isfile(filepath):
         try:
@@ -3036,6 +5157,50 @@ def save_config(filepath, force=False):
             return 0
     return -1
 
+def is_loopback(host):
+    try:
+        return socket.gethostbyname(host or '0.0.0.0').startswith('127.')
+    except socket.error:
+        return False
+
+def run_proxy(address):
+    """Serve the RPC interface of the configured daemon on [HOST:]PORT."""
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+    else:
+        host, port = 'localhost', address
+    # anyone who reaches the proxy can change and delete torrents
+    username, password = config.get('Proxy', 'username'), config.get('Proxy', 'password')
+    if not (username and password) and not is_loopback(host):
+        quit("Refusing to serve %s to the network without [Proxy] username and password in %s\n"
+             % (address, cmd_args.configfile), CONFIGFILE_ERROR)
+    server = ProxyTransmission(config.get('Connection', 'host'),
+                               config.getint('Connection', 'port'),
+                               config.get('Connection', 'path'),
+                               config.get('Connection', 'username'),
+                               config.get('Connection', 'password'))
+    try:
+        httpd = RPCProxyServer((host, int(port)), config.get('Proxy', 'whitelist'), username, password)
+    except (ValueError, socket.error), msg:
+        quit("Cannot listen on %s: %s\n" % (address, msg), CONNECTION_ERROR)
+    httpd.proxy = RPCProxy(server)
+    print "Serving %s:%s on %s:%s" % (server.host, server.port, host, port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+    exit(0)
+
+def read_connection(section):
+    """Return host, port, path, username, password and ssl of a [Connection:NAME] section;
+    what it doesn't specify is taken from [Connection]."""
+    def get(option):
+        if config.has_option(section, option):
+            return config.get(section, option)
+        return config.get('Connection', option)
+    return (get('host'), int(get('port')), get('path'), get('username'), get('password'),
+            get('ssl').lower() in ('1', 'yes', 'true', 'on'))
+
 def parse_sort_str(sort_str):
     sort_orders = []
     for i in sort_str.split(','):
@@ -3050,7 +5215,7 @@ def parse_sort_str(sort_str):
 # command line parameters
 default_config_path = os.environ['HOME'] + '/.config/transmission-remote-cli/settings.cfg'
 parser = OptionParser(usage="%prog [options] [-- transmission-remote options]",
-                      version="%%prog %s" % VERSION,
+                      version="%%prog %s (JSON decoder: %s)" % (VERSION, json_decoder_name),
                       description="%%prog %s" % VERSION)
 parser.add_option("-c", "--connect", action="store", dest="connection", default="",
                   help="Point to the server using pattern [username:password@]host[:port]/[path]")
@@ -3064,6 +5229,12 @@ parser.add_option("-n", "--netrc", action="store_true", dest="use_netrc", defaul
                   help="Get authentication info from your ~/.netrc file.")
 parser.add_option("--debug", action="store_true", dest="DEBUG", default=False,
                   help="Everything passed to the debug() function will be added to the file debug.log.")
+parser.add_option("--benchmark-json", action="store", dest="benchmark_json", default="", metavar="FILE",
+                  help="Compare available JSON decoders on the torrent list in FILE. " +
+                       "If FILE doesn't exist, the list is fetched from the server first.")
+parser.add_option("--proxy", action="store", dest="proxy", default="", metavar="[HOST:]PORT",
+                  help="Don't start the interface but serve the RPC interface of the server on " +
+                       "[HOST:]PORT to any number of clients, answering reads from one cache.")
 (cmd_args, transmissionremote_args) = parser.parse_args()
 
 
@@ -3086,6 +5257,17 @@ if cmd_args.ssl:
     config.set('Connection', 'ssl', 'True')
 
 
+# parsed once; a malformed value must not break the worker later
+try:
+    request_timeouts = parse_timeouts(config.get('Connection', 'timeouts'))
+except ValueError, msg:
+    quit("Invalid timeouts in %s: %s\n" % (cmd_args.configfile, msg), CONFIGFILE_ERROR)
+
+if cmd_args.benchmark_json:
+    benchmark_json(cmd_args.benchmark_json)
+
+if cmd_args.proxy:
+    run_proxy(cmd_args.proxy)
 
 # forward arguments after '--' to transmission-remote
 if transmissionremote_args:
@@ -3112,10 +5294,24 @@ if transmissionremote_args:
     quit('', retcode)
 
 
+# a filter query from the config file must be valid before it is used
+if config.get('Filtering', 'filter'):
+    try:
+        compile_filter_query(config.get('Filtering', 'filter'))
+    except ValueError, msg:
+        quit("Invalid filter in %s: %s\n" % (cmd_args.configfile, msg), CONFIGFILE_ERROR)
+
 # run interface
-ui = Interface(Transmission(config.get('Connection', 'host'),
-                            config.getint('Connection', 'port'),
-                            config.get('Connection', 'path'),
-                            config.get('Connection', 'username'),
-                            config.get('Connection', 'password')))
+connections = [('Connection', config.get('Connection', 'host'))] + \
+    [(section, section.split(':', 1)[1]) for section in sorted(config.sections())
+     if section.startswith('Connection:')]
+if len(connections) == 1:
+    server = Transmission(config.get('Connection', 'host'),
+                          config.getint('Connection', 'port'),
+                          config.get('Connection', 'path'),
+                          config.get('Connection', 'username'),
+                          config.get('Connection', 'password'))
+else:
+    server = MultiTransmission([(name, section) + read_connection(section) for section, name in connections])
+ui = Interface(server)
 